@@ -0,0 +1,442 @@
+from datetime import datetime, timedelta, timezone
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import pymongo
+import telethon
+from bs4 import BeautifulSoup
+from telethon.tl.functions.channels import GetChannelsRequest, GetFullChannelRequest, JoinChannelRequest, LeaveChannelRequest
+from telethon.tl.functions.messages import GetPeerDialogsRequest
+from telethon.tl.types import Channel, ChannelFull, ChatPhotoEmpty, Dialog, Message, PeerChannel, PeerNotifySettings, PeerUser, PhotoEmpty, UpdateNewChannelMessage, User
+from telethon.tl.types.messages import Chats, ChatFull, PeerDialogs
+from telethon.tl.types.updates import State
+from broker import MongoBroker
+from indexes import IndexManager
+from master import MonitoringMaster
+from tgstat import TGStatScraper
+from worker import MonitoringWorker
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+# the benchmark must not be slowed down by the rate limiter, only by the fake latency and flood waits
+RATES = {name: {'rate': 1000, 'capacity': 1000, 'max_rate': 1000} for name in ('join', 'history', 'full_channel', 'dialogs')}
+
+
+class FakeTelegram:
+    def __init__(self, n_groups, messages=200, rate=1, latency=0.01, flood_rate=0, flood_seconds=1, invite_rate=0, approve_after=5, seed=0):
+        """Groups ```g0```...```g{n_groups-1}``` seen by the fake clients. Each group starts with ```messages``` messages
+        written in the last week and receives ```rate``` new messages per second. Every request takes ```latency``` seconds,
+        fails with a FloodWaitError of ```flood_seconds``` with probability ```flood_rate```, and a join is turned into a
+        join request, approved after ```approve_after``` seconds, with probability ```invite_rate```."""
+        self.n_groups = n_groups
+        self.messages = messages
+        self.rate = rate
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.invite_rate = invite_rate
+        self.approve_after = approve_after
+        self.seed = seed
+        self.start = datetime.now(tz=timezone.utc)
+
+
+    def username(self, index):
+        return f"g{index}"
+
+
+    def group_id(self, username):
+        return 1000000 + int(username[1:])
+
+
+    def channel(self, group_id, left=False):
+        return Channel(id=group_id, title=f"Group {group_id}", photo=ChatPhotoEmpty(), date=self.start, access_hash=group_id,
+                       username=self.username(group_id - 1000000), megagroup=True, left=left)
+
+
+    def full_channel(self, group_id):
+        full_chat = ChannelFull(id=group_id, about="", read_inbox_max_id=0, read_outbox_max_id=0, unread_count=0,
+                                chat_photo=PhotoEmpty(id=0), notify_settings=PeerNotifySettings(), bot_info=[], pts=0)
+        return ChatFull(full_chat=full_chat, chats=[self.channel(group_id)], users=[])
+
+
+    def last_message_id(self):
+        return self.messages + int(self.rate * (datetime.now(tz=timezone.utc) - self.start).total_seconds())
+
+
+    def date(self, message_id):
+        if message_id <= self.messages:
+            return self.start - timedelta(days=7) * (self.messages - message_id) / self.messages
+        return self.start + timedelta(seconds=(message_id - self.messages) / self.rate)
+
+
+    def message(self, group_id, message_id):
+        return Message(id=message_id, peer_id=PeerChannel(group_id), date=self.date(message_id),
+                       message=f"Message {message_id} of group {group_id}", from_id=PeerUser(message_id % 50))
+
+
+class FakeDialog:
+    def __init__(self, entity, date):
+        self.entity = entity
+        self.date = date
+        self.pinned = False
+
+
+class FakeClient:
+    """Stand-in for ```TelegramClient``` implementing the calls made by ```MonitoringWorker```."""
+    def __init__(self, telegram, pid):
+        self.telegram = telegram
+        self.random = random.Random(telegram.seed + pid)
+        self.pid = pid
+        # group id -> date joined, group id -> date the join request was sent
+        self.joined = {}
+        self.requested = {}
+        self._loop = None
+        # callbacks of the update stream, started by the first add_event_handler()
+        self.handlers = []
+        self.pusher = None
+        # group id -> last message pushed, updates start when the group is joined
+        self.pushed = {}
+
+
+    @property
+    def loop(self):
+        # created lazily, so that the client can be moved to a forked process
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+        return self._loop
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        pass
+
+
+    def disconnect(self):
+        pass
+
+
+    def is_connected(self):
+        return True
+
+
+    def add_event_handler(self, callback, event=None):
+        self.handlers.append(callback)
+        if self.pusher is None:
+            self.pusher = asyncio.ensure_future(self.__push())
+
+
+    async def __push(self):
+        # new messages of the joined groups are pushed every 100 ms, as Telegram sends updates
+        while True:
+            await asyncio.sleep(0.1)
+            last = self.telegram.last_message_id()
+            for group_id in list(self.joined):
+                for message_id in range(self.pushed.get(group_id, last) + 1, last + 1):
+                    for handler in self.handlers:
+                        await handler(UpdateNewChannelMessage(self.telegram.message(group_id, message_id), message_id, 1))
+                self.pushed[group_id] = last
+
+
+    async def __request(self):
+        await asyncio.sleep(self.telegram.latency)
+        if self.random.random() < self.telegram.flood_rate:
+            raise telethon.errors.FloodWaitError(request=None, capture=self.telegram.flood_seconds)
+
+
+    def __approve(self):
+        now = datetime.now(tz=timezone.utc)
+        for group_id, date in list(self.requested.items()):
+            if (now - date).total_seconds() >= self.telegram.approve_after:
+                del self.requested[group_id]
+                self.joined[group_id] = now
+                self.pushed[group_id] = self.telegram.last_message_id()
+
+
+    async def get_me(self):
+        return User(id=self.pid, username=f"fake_account_{self.pid}")
+
+
+    async def __call__(self, request):
+        await self.__request()
+        if isinstance(request, GetChannelsRequest):
+            return Chats(chats=[self.telegram.channel(channel.channel_id) for channel in request.id if channel.channel_id in self.joined])
+        if isinstance(request, GetPeerDialogsRequest):
+            now = datetime.now(tz=timezone.utc)
+            last = self.telegram.last_message_id()
+            dialogs = [Dialog(PeerChannel(peer.peer.channel_id), last, 0, 0, 0, 0, 0, PeerNotifySettings())
+                       for peer in request.peers if peer.peer.channel_id in self.joined]
+            return PeerDialogs(dialogs=dialogs, messages=[], chats=[], users=[], state=State(pts=0, qts=0, date=now, seq=0, unread_count=0))
+        channel = request.channel
+        group_id = self.telegram.group_id(channel) if isinstance(channel, str) else getattr(channel, 'channel_id', channel)
+        if isinstance(request, GetFullChannelRequest):
+            return self.telegram.full_channel(group_id)
+        if isinstance(request, JoinChannelRequest):
+            if self.random.random() < self.telegram.invite_rate:
+                self.requested[group_id] = datetime.now(tz=timezone.utc)
+                raise telethon.errors.InviteRequestSentError(request=None)
+            self.joined[group_id] = datetime.now(tz=timezone.utc)
+            self.pushed[group_id] = self.telegram.last_message_id()
+            return None
+        if isinstance(request, LeaveChannelRequest):
+            self.joined.pop(group_id, None)
+            return None
+        raise NotImplementedError(type(request).__name__)
+
+
+    async def get_entity(self, peer):
+        await self.__request()
+        self.__approve()
+        return self.telegram.channel(peer.channel_id, left=peer.channel_id not in self.joined)
+
+
+    async def iter_dialogs(self):
+        self.__approve()
+        for group_id, date in sorted(self.joined.items(), key=lambda item: item[1], reverse=True):
+            yield FakeDialog(self.telegram.channel(group_id), date)
+
+
+    async def iter_messages(self, peer, limit=None, reverse=False, wait_time=None, offset_date=None, min_id=0):
+        if peer.channel_id not in self.joined:
+            raise telethon.errors.ChannelPrivateError(request=None)
+        last = self.telegram.last_message_id()
+        first = min_id + 1 if min_id else 1
+        count = 0
+        for message_id in range(first, last + 1):
+            if offset_date is not None and not min_id and self.telegram.date(message_id) <= offset_date:
+                continue
+            if limit is not None and count >= limit:
+                return
+            # messages are fetched in pages of 100
+            if count % 100 == 0:
+                await self.__request()
+            yield self.telegram.message(peer.channel_id, message_id)
+            count += 1
+
+
+class FakeWorker(MonitoringWorker):
+    def __init__(self, telegram, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.telegram = telegram
+
+
+    def bind(self, pid, tasks, events):
+        self.pid = pid
+        self.task_queue = tasks
+        self.events = events
+        self.client = FakeClient(self.telegram, pid)
+
+
+class FixtureSession:
+    def __init__(self, path, latency=0.05):
+        """Serve the pages saved in ```path``` instead of downloading them from tgstat.com, after ```latency``` seconds."""
+        self.path = path
+        self.latency = latency
+
+
+    @staticmethod
+    def file_name(url):
+        return re.sub(r'[^A-Za-z0-9_.@=-]', '_', url.split('://', 1)[-1]) + '.html'
+
+
+    def get(self, url, headers=None):
+        time.sleep(self.latency)
+        response = type('Response', (), {})()
+        response.headers = {}
+        path = os.path.join(self.path, self.file_name(url))
+        if os.path.exists(path):
+            with open(path, 'rb') as file:
+                response.content = file.read()
+            response.status_code = 200
+        else:
+            response.content = b"<html><title>404 Not Found</title></html>"
+            response.status_code = 404
+        return response
+
+
+def write_fixtures(path, topics, groups_per_topic):
+    """Write a home page, a ranking for each topic and a page for each group, with the markup parsed by ```TGStatScraper```."""
+    os.makedirs(path, exist_ok=True)
+    def save(url, html):
+        with open(os.path.join(path, FixtureSession.file_name(url)), 'w') as file:
+            file.write(html)
+    items = ''.join(f'<a class="dropdown-item" href="ratings/chats/topic{n}">{topic}</a>' for n, topic in enumerate(topics))
+    menu = '<div class="dropdown-menu max-height-320px overflow-y-scroll">{}</div>'
+    save('https://tgstat.com/ratings/chats', f"<html><title>Ratings</title><body>{menu.format('')}{menu.format(items)}</body></html>")
+    index = 0
+    for n, topic in enumerate(topics):
+        cards = []
+        for _ in range(groups_per_topic):
+            username = f"g{index}"
+            cards.append(
+                '<div class="card peer-item-row mb-2 ribbon-box border">'
+                f'<div class="col col-12 col-sm-5 col-md-5 col-lg-4"><a href="https://tgstat.com/chat/@{username}">'
+                f'<div class="text-truncate font-16 text-dark mt-n1">Group {index}</div>'
+                f'<div class="text-truncate font-12 text-dark">{topic}</div></a></div>'
+                f'<div class="text-truncate font-14 text-dark mt-n1">{1000 + index} participants</div>'
+                '<div class="text-center" data-html="true" data-original-title="Number of messages in the group in the last 7 days" '
+                f'data-placement="top" data-toggle="tooltip" data-trigger="click" title="">{index % 5 + 1}.5k\nmessages</div>'
+                f'<h4 class="text-dark font-weight-normal mb-1 font-16 font-sm-18">{100 + index}</h4>'
+                '</div>')
+            save(f"https://tgstat.com/chat/@{username}",
+                 f'<html><title>{username}</title><body><div class="mt-4">Group {index}\nItaly,\nEnglish</div></body></html>')
+            index += 1
+        save(f"https://tgstat.com/ratings/chats/topic{n}/public?sort=mau", f"<html><title>{topic}</title><body>{''.join(cards)}</body></html>")
+
+
+def total(metrics, name, **labels):
+    """Sum of the values of ```name``` (sum and count for histograms) over the series matching ```labels```."""
+    result = [0, 0]
+    for (key, key_labels), value in list(metrics.values.items()):
+        if key != name or any(dict(key_labels).get(label) != wanted for label, wanted in labels.items()):
+            continue
+        if isinstance(value, list):
+            result[0] += value[1]
+            result[1] += value[2]
+        else:
+            result[0] += value
+    return result if metrics.types[name][0] == 'histogram' else result[0]
+
+
+def wait_idle(master):
+    while sum(master.busy) > 0:
+        master.get_results(block=True, timeout=60)
+
+
+def counts(master):
+    return total(master.metrics, 'tasks_dispatched_total'), total(master.metrics, 'messages_total')
+
+
+def report(phase, seconds, before, after):
+    dispatched = after[0] - before[0]
+    messages = after[1] - before[1]
+    print(f"{phase:>9}: {dispatched} tasks in {seconds:.2f} s ({dispatched / seconds:.1f} tasks/s), "
+          f"{messages} messages ({messages / seconds:.1f} messages/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the crawler with fake Telegram accounts and saved TGStat pages.")
+    parser.add_argument('--groups', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--concurrent-tasks', type=int, default=1)
+    parser.add_argument('--messages', type=int, default=200, help="messages in each group when it is joined")
+    parser.add_argument('--rate', type=float, default=1, help="new messages per second in each group")
+    parser.add_argument('--latency', type=float, default=0.01, help="seconds taken by each Telegram request")
+    parser.add_argument('--flood-rate', type=float, default=0, help="probability of a FloodWaitError for each request")
+    parser.add_argument('--flood-seconds', type=int, default=1)
+    parser.add_argument('--invite-rate', type=float, default=0, help="probability that joining a group needs approval")
+    parser.add_argument('--check-seconds', type=float, default=10, help="duration of the check phase")
+    parser.add_argument('--topics', type=int, default=4)
+    parser.add_argument('--fixtures', help="directory with the saved TGStat pages (generated if missing)")
+    parser.add_argument('--http-latency', type=float, default=0.05, help="seconds taken by each TGStat page")
+    parser.add_argument('--mongodb', help="connection string of a local MongoDB, an in-memory mongomock database is used otherwise")
+    parser.add_argument('--message-store', choices=('per_group', 'single'), default='per_group')
+    parser.add_argument('--live', action='store_true', help="receive new messages from the update stream of the fake accounts")
+    parser.add_argument('--broker', action='store_true', help="pass tasks and events through the MongoDB broker instead of local queues")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='tgbenchmark_')
+    fixtures = os.path.abspath(args.fixtures) if args.fixtures is not None else os.path.join(directory, 'fixtures')
+    topics = [f"Topic {n}" for n in range(args.topics)]
+    if not os.path.exists(fixtures):
+        write_fixtures(fixtures, topics, -(-args.groups // args.topics))
+    # session, dialog, rate limiter and metrics files of the workers
+    os.chdir(directory)
+    dbname = f"benchmark_{int(time.time())}"
+    if args.mongodb is None:
+        if mongomock is None:
+            sys.exit("mongomock is not installed, pass --mongodb <connection string>")
+        client = mongomock.MongoClient()
+        pymongo.MongoClient = lambda *a, **k: client
+        # explain() is not available in mongomock
+        IndexManager.report = lambda self, collections=None: []
+        connection_string = 'mongomock://'
+    else:
+        connection_string = args.mongodb
+
+    telegram = FakeTelegram(args.groups, args.messages, args.rate, args.latency, args.flood_rate, args.flood_seconds, args.invite_rate)
+    workers = [FakeWorker(telegram, 0, "", connection_string, dbname=dbname, rates=RATES, concurrent_tasks=args.concurrent_tasks,
+                          message_store=args.message_store, live=args.live) for _ in range(args.workers)]
+    broker = MongoBroker(connection_string, dbname, poll_interval=0.05) if args.broker else None
+    master = MonitoringMaster(workers, connection_string, dbname=dbname, metrics_path=None, broker=broker)
+    if args.mongodb is None:
+        # an in-memory database cannot be shared with other processes
+        for i, worker in enumerate(workers):
+            master.free.append(i)
+            master.tasks.append(multiprocessing.Queue() if broker is None else broker.tasks(i))
+            worker.bind(i, master.tasks[i], master.events)
+            threading.Thread(target=worker.launch_client, daemon=True).start()
+    else:
+        master.run_workers()
+
+    # TGStat: rankings and group pages are read from the fixtures
+    scraper = TGStatScraper('https://tgstat.com/ratings/chats', connection_string, dbname=dbname, connect=False, cache_path=None,
+                            metrics=master.metrics, session=FixtureSession(fixtures, args.http_latency))
+    scraper.response = scraper.request(scraper.url)
+    scraper.soup = BeautifulSoup(scraper.response.content, 'html.parser')
+    scraper.get_topic_list()
+    start = time.monotonic()
+    scraper.get_group_rankings(topics, sort='mau')
+    for topic in topics:
+        scraper.enrich_topic_with_language(topic)
+        scraper.send_to_processing(topic)
+    tgstat_seconds = time.monotonic() - start
+
+    # every group is due again as soon as it has been checked
+    master.scheduler.threshold_check = 0
+    start = time.monotonic()
+    master.crawl('join')
+    wait_idle(master)
+    join_seconds = time.monotonic() - start
+    joined = counts(master)
+
+    start = time.monotonic()
+    master.crawl('check', tdelta=args.check_seconds / 3600)
+    wait_idle(master)
+    check_seconds = time.monotonic() - start
+    checked = counts(master)
+
+    start = time.monotonic()
+    master.update_usernames()
+    refresh_seconds = time.monotonic() - start
+    refreshed = counts(master)
+
+    print(f"\n{args.groups} groups, {args.workers} workers, {args.concurrent_tasks} tasks per worker, "
+          f"{'MongoDB' if args.mongodb else 'mongomock'}, {args.message_store} message store{', broker' if args.broker else ''}{', live' if args.live else ''}")
+    parse, pages = total(master.metrics, 'parse_seconds')
+    print(f"TGStat: {pages} pages parsed in {tgstat_seconds:.2f} s, {1000 * parse / max(pages, 1):.2f} ms per page")
+    report('join', join_seconds, (0, 0), joined)
+    report('check', check_seconds, joined, checked)
+    report('usernames', refresh_seconds, checked, refreshed)
+    for name in ('queue', 'limiter', 'api', 'write', 'total'):
+        seconds, count = total(master.metrics, 'task_span_seconds', span=name)
+        if count > 0:
+            print(f"{name:>8}: {1000 * seconds / count:.1f} ms per task")
+
+    if args.mongodb is not None:
+        for process in master.processes:
+            process.terminate()
+        pymongo.MongoClient(connection_string).drop_database(dbname)
+    os.chdir('/')
+    shutil.rmtree(directory, ignore_errors=True)
+    sys.stdout.flush()
+    # worker threads block on their task queues
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+from datetime import datetime, timedelta, timezone
+from indexes import IndexManager
+import os
+import pymongo
+import queue
+import socket
+import threading
+import time
+import uuid
+
+
+TASKS = 'broker_tasks'
+EVENTS = 'broker_events'
+# slots and last heartbeat of the running workers
+WORKERS = 'broker_workers'
+# lease of the documents nobody has claimed yet
+UNCLAIMED = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class MongoBroker:
+    def __init__(self, connection_string, dbname='GroupMonitoring_on_Telegram', lease=300, heartbeat=60, poll_interval=0.5):
+        """Pass tasks and events between the master and workers running on any host through MongoDB.
+        Each task is a document of ```broker_tasks``` claimed atomically by the worker it is addressed to for ```lease```
+        seconds; the lease is renewed every ```heartbeat``` seconds while the task runs and the task is deleted once its
+        result has been sent, so the task of a worker that died is claimed again when its lease expires.
+        Results and free slots are documents of ```broker_events```, deleted once the master has applied them.
+        Running workers renew their entry in ```broker_workers``` every ```heartbeat``` seconds, so that a restarted
+        master knows how many of their slots are free. Queues poll MongoDB every ```poll_interval``` seconds while they are empty."""
+        self.connection_string = connection_string
+        self.dbname = dbname
+        self.lease = lease
+        self.heartbeat = heartbeat
+        self.poll_interval = poll_interval
+        self.client = None
+        self.pid = None
+
+
+    @property
+    def db(self):
+        # a connection cannot be shared with forked processes
+        if self.client is None or self.pid != os.getpid():
+            self.client = pymongo.MongoClient(self.connection_string, tz_aware=True)
+            self.pid = os.getpid()
+        return self.client[self.dbname]
+
+
+    def ensure_indexes(self):
+        IndexManager(self.db).ensure([TASKS, EVENTS])
+
+
+    def recover(self, n_workers):
+        """Take over the tasks and events left by a previous run of the master: tasks are still run by their workers,
+        events it claimed without applying them are released, tasks of workers that no longer exist are dropped."""
+        tasks = self.db[TASKS].delete_many({'worker_id': {'$not': {'$in': list(range(n_workers))}}}).deleted_count
+        # the master is the only consumer of the events
+        events = self.db[EVENTS].update_many({'lease_until': {'$gt': UNCLAIMED}}, {'$set': {'lease_until': UNCLAIMED}}).modified_count
+        if tasks + events > 0:
+            print(f"{datetime.now()} - [BROKER] Dropped {tasks} tasks of removed workers, released {events} events of a previous run")
+
+
+    def free_slots(self, worker_id):
+        """Slots of ```worker_id``` the master can use when it starts. A running worker has all its slots but the ones
+        taken by its tasks or already announced as free; a worker that is not running yet announces all its slots but
+        one when it starts, that one is held by the master."""
+        worker = self.db[WORKERS].find_one({'_id': worker_id})
+        alive = datetime.now(tz=timezone.utc) - timedelta(seconds=2 * self.heartbeat)
+        if worker is None or worker['heartbeat'] < alive:
+            return 1
+        tasks = self.db[TASKS].count_documents({'worker_id': worker_id})
+        announced = self.db[EVENTS].count_documents({'kind': 'FREE', 'payload': worker_id})
+        return max(0, worker['slots'] - tasks - announced)
+
+
+    def tasks(self, worker_id):
+        return TaskQueue(self, worker_id)
+
+
+    def events(self):
+        return EventQueue(self)
+
+
+    def claim(self, collection, filter, owner):
+        """Claim the oldest document of ```collection``` matching ```filter``` whose lease has expired, None if there is none."""
+        now = datetime.now(tz=timezone.utc)
+        filter = dict(filter, lease_until={'$lt': now})
+        update = {'$set': {'lease_until': now + timedelta(seconds=self.lease), 'owner': owner, 'host': socket.gethostname()}, '$inc': {'attempts': 1}}
+        return self.db[collection].find_one_and_update(filter, update, sort=[('_id', 1)], return_document=pymongo.ReturnDocument.AFTER)
+
+
+    def wait(self, function, block, timeout):
+        # poll until function returns something, the queue module is used to signal a timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            item = function()
+            if item is not None:
+                return item
+            if not block or (deadline is not None and time.monotonic() >= deadline):
+                raise queue.Empty
+            wait = self.poll_interval if deadline is None else min(self.poll_interval, max(0, deadline - time.monotonic()))
+            time.sleep(wait)
+
+
+class TaskQueue:
+    def __init__(self, broker, worker_id):
+        """Tasks addressed to ```worker_id```, with the interface of the ```multiprocessing.Queue``` used by local workers
+        and an ```ack(task)``` to call once the result of a task has been sent."""
+        self.broker = broker
+        self.worker_id = worker_id
+        self.owner = uuid.uuid4().hex
+        # ids of the tasks claimed and not acknowledged yet, their leases are renewed by the heartbeat
+        self.claimed = set()
+        # slots of the worker taking the tasks, set by register()
+        self.slots = None
+        self.lock = threading.Lock()
+        self.heartbeat = None
+
+
+    def put(self, task):
+        self.broker.db[TASKS].insert_one({'worker_id': self.worker_id, 'task': task, 'lease_until': UNCLAIMED, 'attempts': 0})
+
+
+    def __claim(self):
+        document = self.broker.claim(TASKS, {'worker_id': self.worker_id}, self.owner)
+        if document is None:
+            return None
+        if document['attempts'] > 1:
+            print(f"{datetime.now()} - [BROKER] Task {document['task']['name']} claimed again after its lease expired (attempt {document['attempts']})")
+        with self.lock:
+            self.claimed.add(document['_id'])
+        task = document['task']
+        task['lease'] = document['_id']
+        return task
+
+
+    def register(self, slots):
+        """Announce that a worker with ```slots``` slots takes the tasks of this queue, the heartbeat keeps the entry alive."""
+        self.slots = slots
+        self.__beat()
+        self.__start()
+
+
+    def __start(self):
+        # the heartbeat thread is started in the process that claims the tasks
+        if self.heartbeat is None:
+            self.heartbeat = threading.Thread(target=self.__renew, daemon=True)
+            self.heartbeat.start()
+
+
+    def get(self, block=True, timeout=None):
+        self.__start()
+        return self.broker.wait(self.__claim, block, timeout)
+
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+
+    def ack(self, task):
+        with self.lock:
+            self.claimed.discard(task['lease'])
+        # a task claimed by another worker after the lease expired is not ours to delete
+        self.broker.db[TASKS].delete_one({'_id': task['lease'], 'owner': self.owner})
+
+
+    def __beat(self):
+        self.broker.db[WORKERS].update_one(
+            {'_id': self.worker_id},
+            {'$set': {'slots': self.slots, 'heartbeat': datetime.now(tz=timezone.utc), 'host': socket.gethostname()}},
+            upsert=True
+        )
+
+
+    def __renew(self):
+        while True:
+            time.sleep(self.broker.heartbeat)
+            with self.lock:
+                claimed = list(self.claimed)
+            try:
+                if self.slots is not None:
+                    self.__beat()
+                if len(claimed) > 0:
+                    lease_until = datetime.now(tz=timezone.utc) + timedelta(seconds=self.broker.lease)
+                    self.broker.db[TASKS].update_many({'_id': {'$in': claimed}, 'owner': self.owner}, {'$set': {'lease_until': lease_until}})
+            except Exception as e:
+                print(f"{datetime.now()} - [BROKER] [!] Could not renew the leases of worker {self.worker_id}: {e}")
+
+
+    def qsize(self):
+        return self.broker.db[TASKS].count_documents({'worker_id': self.worker_id})
+
+
+class EventQueue:
+    def __init__(self, broker):
+        """Results and free slots sent by the workers to the master, with the interface of a ```multiprocessing.Queue```.
+        Events returned by ```get``` are deleted by ```ack()```, after the master has saved their updates."""
+        self.broker = broker
+        self.owner = uuid.uuid4().hex
+        self.claimed = []
+
+
+    def put(self, event):
+        kind, payload = event
+        self.broker.db[EVENTS].insert_one({'kind': kind, 'payload': payload, 'lease_until': UNCLAIMED, 'attempts': 0})
+
+
+    def __claim(self):
+        document = self.broker.claim(EVENTS, {}, self.owner)
+        if document is None:
+            return None
+        self.claimed.append(document['_id'])
+        return document['kind'], document['payload']
+
+
+    def get(self, block=True, timeout=None):
+        return self.broker.wait(self.__claim, block, timeout)
+
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+
+    def ack(self):
+        if len(self.claimed) > 0:
+            self.broker.db[EVENTS].delete_many({'_id': {'$in': self.claimed}})
+            self.claimed = []
+
+
+    def qsize(self):
+        return self.broker.db[EVENTS].count_documents({})
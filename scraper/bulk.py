@@ -0,0 +1,81 @@
+from pymongo import UpdateOne
+
+
+def _conflict(a, b):
+    # two paths conflict if they are equal or one contains the other
+    return a == b or a.startswith(b + '.') or b.startswith(a + '.')
+
+
+def _paths(update):
+    return [(operator, path) for operator, fields in update.items() for path in fields]
+
+
+class BulkUpdates:
+    def __init__(self, collection, touch=None):
+        """Collect ```update_one``` calls and send them with a single ```bulk_write```.
+        Updates to the same document (same filter) are merged into one operation when their paths do not conflict:
+        ```$set``` values are overwritten, ```$push``` and ```$addToSet``` values are appended with ```$each``` (keeping ```$slice```).
+        If ```touch``` is given, every update also sets that field to the current date of the server."""
+        self.collection = collection
+        self.touch = touch
+        self.updates = []
+        # filter -> position of the last operation with that filter
+        self.positions = {}
+
+
+    def __mergeable(self, position, filter, update):
+        current = self.updates[position][1]
+        for operator, path in _paths(update):
+            for other_operator, other_path in _paths(current):
+                if _conflict(path, other_path) and not (operator == other_operator and path == other_path):
+                    return False
+        # moving the update before the following operations must not change their outcome
+        for _, later in self.updates[position + 1:]:
+            for _, path in _paths(later):
+                if any(_conflict(path, other) for other in list(filter.keys()) + [p for _, p in _paths(update)]):
+                    return False
+        return True
+
+
+    def __add(self, current, update):
+        for operator, fields in update.items():
+            target = current.setdefault(operator, {})
+            for path, value in fields.items():
+                if operator in ('$push', '$addToSet'):
+                    values = value['$each'] if isinstance(value, dict) and '$each' in value else [value]
+                    target.setdefault(path, {'$each': []})['$each'].extend(values)
+                    if isinstance(value, dict) and '$slice' in value:
+                        target[path]['$slice'] = value['$slice']
+                elif operator in ('$max', '$min') and path in target:
+                    target[path] = max(target[path], value) if operator == '$max' else min(target[path], value)
+                else:
+                    target[path] = value
+
+
+    def update_one(self, filter, update):
+        if self.touch is not None:
+            update = dict(update)
+            update['$currentDate'] = {self.touch: True}
+        key = tuple(sorted(filter.items()))
+        position = self.positions.get(key)
+        if position is not None and self.__mergeable(position, filter, update):
+            self.__add(self.updates[position][1], update)
+            return
+        self.positions[key] = len(self.updates)
+        current = {}
+        self.__add(current, update)
+        self.updates.append((dict(filter), current))
+
+
+    def __len__(self):
+        return len(self.updates)
+
+
+    def flush(self):
+        """Send the pending operations in order, return the ```BulkWriteResult``` or None if there was nothing to send."""
+        if len(self.updates) == 0:
+            return None
+        operations = [UpdateOne(filter, update) for filter, update in self.updates]
+        self.updates = []
+        self.positions = {}
+        return self.collection.bulk_write(operations, ordered=True)
@@ -0,0 +1,168 @@
+from datetime import datetime
+import asyncio
+import json
+import os
+import time
+import telethon
+from telethon.tl.types import Channel, Chat, InputPeerChannel, InputPeerChat
+from util import wait_time
+
+
+class DialogIndex:
+    def __init__(self, client, path, limiter=None, refresh_interval=60):
+        """Map the id of every group the account is in to its input peer, so that a group can be
+        resolved without walking ```iter_dialogs()```. The index is saved as JSON in ```path```.
+        Walks are paced by the ```dialogs``` class of ```limiter``` and groups missing from the index
+        trigger at most one refresh every ```refresh_interval``` seconds."""
+        self.client = client
+        self.path = path
+        self.limiter = limiter
+        self.refresh_interval = refresh_interval
+        # time.monotonic() of the end of the last refresh
+        self.refreshed = None
+        # entity id -> {'type': 'channel' | 'chat', 'access_hash': int | None}
+        self.peers = {}
+        # date of the most recent dialog seen while refreshing
+        self.synced = None
+        self.built = False
+        self.lock = asyncio.Lock()
+
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as file:
+                data = json.load(file)
+            self.peers = {int(entity_id): peer for entity_id, peer in data['peers'].items()}
+            self.synced = None if data['synced'] is None else datetime.fromisoformat(data['synced'])
+            self.built = True
+        except Exception as e:
+            print(f"{datetime.now()} - [DIALOGS] [!] Could not load {self.path}, rebuilding the index: {e}")
+            self.peers = {}
+            self.synced = None
+
+
+    def save(self):
+        data = {
+            'synced': None if self.synced is None else self.synced.isoformat(),
+            'peers': {str(entity_id): peer for entity_id, peer in self.peers.items()}
+        }
+        # write to a temporary file first so that a crash does not leave a truncated index
+        with open(self.path + '.tmp', 'w') as file:
+            json.dump(data, file)
+        os.replace(self.path + '.tmp', self.path)
+
+
+    def add(self, entity, save=True):
+        """Index ```entity``` (a ```Channel``` or a ```Chat```), other entities are ignored."""
+        if isinstance(entity, Channel):
+            self.peers[entity.id] = {'type': 'channel', 'access_hash': entity.access_hash}
+        elif isinstance(entity, Chat):
+            self.peers[entity.id] = {'type': 'chat', 'access_hash': None}
+        else:
+            return
+        if save:
+            self.save()
+
+
+    def remove(self, entity_id):
+        if self.peers.pop(entity_id, None) is not None:
+            self.save()
+
+
+    def get(self, entity_id):
+        peer = self.peers.get(entity_id)
+        if peer is None:
+            return None
+        if peer['type'] == 'channel':
+            return InputPeerChannel(entity_id, peer['access_hash'])
+        return InputPeerChat(entity_id)
+
+
+    async def __iter_dialogs(self):
+        # iter_dialogs() sends a GetDialogs request for every 100 dialogs, each one takes a token
+        if self.limiter is not None:
+            await self.limiter.acquire('dialogs')
+        count = 0
+        async for dialog in self.client.iter_dialogs():
+            yield dialog
+            count += 1
+            if count % 100 == 0 and self.limiter is not None:
+                self.limiter.success('dialogs')
+                await self.limiter.acquire('dialogs')
+
+
+    def __flood(self, e):
+        wait = wait_time(e)
+        print(f"{datetime.now()} - [DIALOGS] [!] Flood Error: Waiting for {wait} seconds. ({e})")
+        if self.limiter is not None:
+            self.limiter.flood('dialogs', wait)
+
+
+    async def build(self):
+        async with self.lock:
+            peers, self.peers = self.peers, {}
+            synced = None
+            try:
+                async for dialog in self.__iter_dialogs():
+                    self.add(dialog.entity, save=False)
+                    if dialog.date is not None and (synced is None or dialog.date > synced):
+                        synced = dialog.date
+            except telethon.errors.FloodWaitError as e:
+                # the previous index is kept, it is built again by the next refresh
+                self.__flood(e)
+                self.peers = peers
+                return
+            self.synced = synced
+            self.built = True
+            self.refreshed = time.monotonic()
+            self.save()
+        print(f"{datetime.now()} - [DIALOGS] Index built with {len(self.peers)} groups")
+
+
+    async def refresh(self):
+        """Read dialogs starting from the most recent one, stop at the first indexed dialog with no activity since the last refresh.
+        Return False if the index was refreshed less than ```refresh_interval``` seconds ago and was left as it is."""
+        if not self.built:
+            await self.build()
+            return True
+        async with self.lock:
+            # the groups missing while a refresh runs wait for it instead of starting another one
+            if self.refreshed is not None and time.monotonic() - self.refreshed < self.refresh_interval:
+                return False
+            synced = self.synced
+            newest = synced
+            try:
+                async for dialog in self.__iter_dialogs():
+                    # pinned dialogs come first whatever their date is
+                    if not dialog.pinned and synced is not None and dialog.date is not None \
+                            and dialog.date <= synced and dialog.entity.id in self.peers:
+                        break
+                    self.add(dialog.entity, save=False)
+                    if dialog.date is not None and (newest is None or dialog.date > newest):
+                        newest = dialog.date
+            except telethon.errors.FloodWaitError as e:
+                # the dialogs that were not read are read by the next refresh, which starts from the same date
+                self.__flood(e)
+                newest = synced
+            self.synced = newest
+            self.refreshed = time.monotonic()
+            self.save()
+        return True
+
+
+    async def resolve(self, entity_id):
+        """Return the input peer of ```entity_id```, refreshing the index once if it is unknown."""
+        peer = self.get(entity_id)
+        if peer is None:
+            await self.refresh()
+            peer = self.get(entity_id)
+        return peer
+
+
+    async def resolve_many(self, entity_ids):
+        """Return the input peers of ```entity_ids``` (None for the unknown ones) after at most one refresh."""
+        if any(self.get(entity_id) is None for entity_id in entity_ids):
+            await self.refresh()
+        return [self.get(entity_id) for entity_id in entity_ids]
@@ -0,0 +1,76 @@
+from datetime import datetime
+import base64
+import hashlib
+import json
+
+
+# fields that change at every fetch of a full channel, they are stored but not hashed
+VOLATILE_FIELDS = ('participants_count', 'online_count', 'kicked_count', 'banned_count', 'admins_count',
+                   'read_inbox_max_id', 'read_outbox_max_id', 'unread_count', 'pts', 'available_min_id', 'status')
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode()
+    return str(value)
+
+
+def _stable(value):
+    if isinstance(value, dict):
+        return {key: _stable(item) for key, item in value.items() if key not in VOLATILE_FIELDS}
+    if isinstance(value, list):
+        return [_stable(item) for item in value]
+    return value
+
+
+def _user_ids(entity):
+    return {user['id'] for user in entity.get('users', []) if isinstance(user, dict) and 'id' in user}
+
+
+class EntityStore:
+    def __init__(self, db, name='entities', log_size=20):
+        """Store the full channels of the groups in the ```name``` collection, one document for each distinct content,
+        keyed by the sha256 of its canonical JSON. A group keeps only the hash of its current snapshot in ```entity_hash```
+        and the last ```log_size``` changes in ```entity_log```."""
+        self.db = db
+        self.name = name
+        self.log_size = log_size
+
+
+    def hash(self, entity):
+        canonical = json.dumps(_stable(entity), sort_keys=True, separators=(',', ':'), default=_default, ensure_ascii=False)
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+    def get(self, hash):
+        if hash is None:
+            return None
+        snapshot = self.db[self.name].find_one({'_id': hash}, projection={'entity': 1})
+        return None if snapshot is None else snapshot['entity']
+
+
+    def put(self, hash, entity, timestamp):
+        # a snapshot is never modified: groups with the same content share it
+        self.db[self.name].update_one({'_id': hash}, {'$setOnInsert': {'entity': entity, 'created': timestamp}}, upsert=True)
+
+
+    def record(self, old_hash, entity, timestamp):
+        """Save ```entity``` if its content differs from snapshot ```old_hash``` (the current one of the group).
+        Return the update of the group pointing to the new snapshot, or None if nothing changed."""
+        hash = self.hash(entity)
+        if hash == old_hash:
+            return None
+        self.put(hash, entity, timestamp)
+        change = {'timestamp': timestamp, 'hash': hash}
+        old = self.get(old_hash)
+        if old is not None:
+            # bots added or removed since the previous snapshot
+            new_users, old_users = _user_ids(entity), _user_ids(old)
+            change['users_added'] = sorted(new_users - old_users)
+            change['users_removed'] = sorted(old_users - new_users)
+        return {
+            '$set': {'entity_hash': hash},
+            '$push': {'entity_log': {'$each': [change], '$slice': -self.log_size}}
+        }
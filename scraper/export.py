@@ -0,0 +1,147 @@
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from store import MessageStore
+import argparse
+import base64
+import gzip
+import json
+import os
+import pymongo
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# columns of the Parquet files, the other fields of a message are stored as JSON in ```extra```
+COLUMNS = ('group_id', 'username', 'topic', 'id', 'date', 'message', 'from_id', 'reply_to', 'views', 'forwards')
+FORMATS = ('jsonl', 'parquet')
+
+
+def to_json(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode()
+    return str(value)
+
+
+class CorpusExporter:
+    def __init__(self, db, output, format='jsonl', store=None, batch_size=10000, name=None, margin=60):
+        """Export the messages of the joined groups to ```output```, partitioned as ```topic=<topic>/date=<YYYY-MM-DD>```.
+        Messages are read in insertion order (```_id```) with a cursor ```batch_size``` at a time; each batch is written
+        to its own files and then the ```_id``` of its last message is saved as the watermark of the group in the
+        ```exports``` collection, so the next run (or a restarted one) only exports the messages stored since, older
+        messages filled in later included. Messages stored in the last ```margin``` seconds are left to the next run,
+        since the ```_id``` of documents written by different processes in the same second are not ordered."""
+        if format not in FORMATS:
+            raise ValueError(f"Unknown format '{format}', expected one of {FORMATS}")
+        if format == 'parquet' and pyarrow is None:
+            raise ImportError("pyarrow is required to export to Parquet")
+        self.db = db
+        self.output = output
+        self.format = format
+        self.store = MessageStore(db) if store is None else store
+        self.batch_size = batch_size
+        # exports to different destinations keep different watermarks
+        self.name = os.path.basename(os.path.normpath(output)) if name is None else name
+        self.margin = margin
+
+
+    def export(self, topics=None):
+        # groups that were never joined have no id
+        query = {'id': {'$nin': [None, ""]}}
+        if topics is not None:
+            query['topic'] = {'$in': topics}
+        cursor = self.db['groups'].find(query, projection={'_id': 0, 'id': 1, 'username': 1, 'topic': 1, 'collection_name': 1})
+        total = 0
+        for group in cursor:
+            total += self.export_group(group)
+        print(f"{datetime.now()} - [EXPORT] {total} messages exported to {self.output}")
+        return total
+
+
+    def export_group(self, group):
+        watermark_id = f"{self.name}:{group['id']}"
+        watermark = self.db['exports'].find_one({'_id': watermark_id})
+        name = group.get('collection_name', self.store.collection_name(group['id']))
+        shared = name != f"messages_{group['id']}"
+        last = None if watermark is None else watermark.get('last')
+        if watermark is not None and last is None:
+            # watermark of an older version, on the message id: continue after the message it points to
+            query = {'id': watermark['last_id']}
+            if shared:
+                query['group_id'] = group['id']
+            message = self.db[name].find_one(query, projection={'_id': 1})
+            last = None if message is None else message['_id']
+        until = ObjectId.from_datetime(datetime.now(tz=timezone.utc) - timedelta(seconds=self.margin))
+        filter = {'_id': {'$lt': until} if last is None else {'$gt': last, '$lt': until}}
+        if shared:
+            # collection shared by several groups
+            filter['group_id'] = group['id']
+        cursor = self.db[name].find(filter, sort=[('_id', 1)], batch_size=self.batch_size)
+        exported = 0
+        batch = []
+        for message in cursor:
+            batch.append(message)
+            if len(batch) == self.batch_size:
+                exported += self.__write_batch(group, batch, watermark_id)
+                batch = []
+        if len(batch) > 0:
+            exported += self.__write_batch(group, batch, watermark_id)
+        return exported
+
+
+    def __write_batch(self, group, batch, watermark_id):
+        last = batch[-1]['_id']
+        partitions = {}
+        for message in batch:
+            del message['_id']
+            day = message['date'].strftime('%Y-%m-%d') if isinstance(message.get('date'), datetime) else 'unknown'
+            message['group_id'] = group['id']
+            message['username'] = group['username']
+            message['topic'] = group.get('topic', '')
+            partitions.setdefault(day, []).append(message)
+        for day, messages in partitions.items():
+            topic = (group.get('topic', '') or 'unknown').replace('/', '_')
+            directory = os.path.join(self.output, f"topic={topic}", f"date={day}")
+            os.makedirs(directory, exist_ok=True)
+            # the file is named after the first message: exporting the same batch again overwrites it
+            path = os.path.join(directory, f"part-{group['id']}-{messages[0]['id']}")
+            if self.format == 'jsonl':
+                path += '.jsonl.gz'
+                with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as file:
+                    for message in messages:
+                        file.write(json.dumps(message, default=to_json, ensure_ascii=False) + '\n')
+            else:
+                path += '.parquet'
+                rows = []
+                for message in messages:
+                    row = {column: message.pop(column, None) for column in COLUMNS}
+                    for column in ('from_id', 'reply_to'):
+                        if row[column] is not None and not isinstance(row[column], int):
+                            row[column] = json.dumps(row[column], default=to_json)
+                    row['extra'] = json.dumps(message, default=to_json, ensure_ascii=False)
+                    rows.append(row)
+                pyarrow.parquet.write_table(pyarrow.Table.from_pylist(rows), path + '.tmp', compression='zstd')
+            os.replace(path + '.tmp', path)
+        self.db['exports'].update_one({'_id': watermark_id}, {'$set': {'last': last, 'date': datetime.now()}, '$unset': {'last_id': ''}}, upsert=True)
+        return len(batch)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export the collected messages partitioned by topic and date.")
+    parser.add_argument('output', help="destination directory")
+    parser.add_argument('--format', choices=FORMATS, default='jsonl')
+    parser.add_argument('--topic', action='append', help="export only the given topic (can be repeated)")
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--store', choices=('per_group', 'single'), default='per_group', help="layout of the message collections")
+    parser.add_argument('--dbname', default='GroupMonitoring_on_Telegram')
+    args = parser.parse_args()
+
+    # read the connection string from data.txt, as main.py does
+    connection_string = open('data.txt', 'r').readline().rstrip()
+    db = pymongo.MongoClient(connection_string)[args.dbname]
+    exporter = CorpusExporter(db, args.output, args.format, MessageStore(db, args.store), args.batch_size)
+    exporter.export(args.topic)
@@ -0,0 +1,170 @@
+from datetime import datetime
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+
+# seconds a page is used without asking tgstat.com again, the first pattern matching the url wins
+DEFAULT_TTLS = [
+    (r'\?sort=', 3600),            # rankings
+    (r'/@|/channel/', 7 * 86400),  # pages of the groups
+]
+DEFAULT_TTL = 86400
+
+
+class Page:
+    """Body of a downloaded or cached page, with the attributes of ```requests.Response``` used by the scraper."""
+    def __init__(self, url, content, status_code=200, from_cache=False):
+        self.url = url
+        self.content = content
+        self.status_code = status_code
+        self.from_cache = from_cache
+        self.hash = hashlib.sha256(content).hexdigest()
+
+
+class HTTPCache:
+    def __init__(self, path, max_size=200 * 2**20, ttls=None, default_ttl=DEFAULT_TTL):
+        """Keep the pages downloaded from tgstat.com in the ```path``` directory, at most ```max_size``` bytes
+        (the least recently used pages are evicted first). A page younger than the TTL of its url is served from disk,
+        an older one is revalidated with ```If-None-Match```/```If-Modified-Since```.
+        The results of parsing a page are saved with it and reused as long as its content does not change."""
+        self.path = path
+        self.max_size = max_size
+        self.ttls = [(re.compile(pattern), ttl) for pattern, ttl in (DEFAULT_TTLS if ttls is None else ttls)]
+        self.default_ttl = default_ttl
+        self.lock = threading.Lock()
+        # url -> {file, hash, size, fetched, accessed, etag, last_modified, memo}
+        self.entries = {}
+        self.size = 0
+        os.makedirs(path, exist_ok=True)
+        self.load()
+
+
+    def load(self):
+        index = os.path.join(self.path, 'index.json')
+        if not os.path.exists(index):
+            return
+        try:
+            with open(index, 'r') as file:
+                entries = json.load(file)
+        except Exception as e:
+            print(f"{datetime.now()} - [CACHE] [!] Could not load {index}: {e}")
+            return
+        for url, entry in entries.items():
+            # pages deleted by hand are forgotten
+            if os.path.exists(os.path.join(self.path, entry['file'])):
+                self.entries[url] = entry
+                self.size += entry['size']
+
+
+    def save(self):
+        index = os.path.join(self.path, 'index.json')
+        with open(index + '.tmp', 'w') as file:
+            json.dump(self.entries, file)
+        os.replace(index + '.tmp', index)
+
+
+    def ttl(self, url):
+        for pattern, ttl in self.ttls:
+            if pattern.search(url):
+                return ttl
+        return self.default_ttl
+
+
+    def __read(self, url, entry):
+        with open(os.path.join(self.path, entry['file']), 'rb') as file:
+            content = file.read()
+        entry['accessed'] = time.time()
+        return Page(url, content, from_cache=True)
+
+
+    def get(self, url):
+        """Cached page of ```url``` if it is still fresh, None otherwise."""
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is None or time.time() - entry['fetched'] > self.ttl(url):
+                return None
+            return self.__read(url, entry)
+
+
+    def headers(self, url):
+        """Headers asking tgstat.com to answer 304 if the cached page of ```url``` did not change."""
+        with self.lock:
+            entry = self.entries.get(url)
+            headers = {}
+            if entry is not None:
+                if entry.get('etag'):
+                    headers['If-None-Match'] = entry['etag']
+                if entry.get('last_modified'):
+                    headers['If-Modified-Since'] = entry['last_modified']
+            return headers
+
+
+    def revalidated(self, url):
+        """The page of ```url``` was not modified: make it fresh again and return it."""
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is None:
+                return None
+            entry['fetched'] = time.time()
+            page = self.__read(url, entry)
+            self.save()
+            return page
+
+
+    def store(self, url, response):
+        page = Page(url, response.content, response.status_code)
+        with self.lock:
+            old = self.entries.get(url)
+            entry = {
+                'file': hashlib.sha256(url.encode()).hexdigest(),
+                'hash': page.hash,
+                'size': len(page.content),
+                'fetched': time.time(),
+                'accessed': time.time(),
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                # parse results are still valid if the content did not change
+                'memo': old['memo'] if old is not None and old['hash'] == page.hash else {},
+            }
+            path = os.path.join(self.path, entry['file'])
+            with open(path + '.tmp', 'wb') as file:
+                file.write(page.content)
+            os.replace(path + '.tmp', path)
+            if old is not None:
+                self.size -= old['size']
+            self.entries[url] = entry
+            self.size += entry['size']
+            self.__evict()
+            self.save()
+        return page
+
+
+    def __evict(self):
+        for url in sorted(self.entries, key=lambda url: self.entries[url]['accessed']):
+            if self.size <= self.max_size:
+                return
+            entry = self.entries.pop(url)
+            self.size -= entry['size']
+            try:
+                os.remove(os.path.join(self.path, entry['file']))
+            except FileNotFoundError:
+                pass
+
+
+    def memo(self, page, name, function):
+        """Result of ```function(page)```, computed only once for each content of the page (results must be JSON)."""
+        with self.lock:
+            entry = self.entries.get(page.url)
+            if entry is not None and entry['hash'] == page.hash and name in entry['memo']:
+                return entry['memo'][name]
+        result = function(page)
+        with self.lock:
+            entry = self.entries.get(page.url)
+            if entry is not None and entry['hash'] == page.hash:
+                entry['memo'][name] = result
+                self.save()
+        return result
@@ -0,0 +1,177 @@
+from datetime import datetime, timezone
+import pymongo
+
+
+# indexes required by the queries of master, workers and scraper: collection -> [(keys, options)]
+INDEXES = {
+    'groups': [
+        ([('worker_id', 1), ('state', 1), ('last_update', 1)], {}),
+        ([('username', 1)], {}),
+        ([('id', 1)], {}),
+        ([('state', 1), ('topic', 1)], {}),
+        ([('state', 1), ('lease_until', 1)], {}),
+        ([('updated_at', 1)], {}),
+    ],
+    'seed': [
+        ([('tg_link', 1)], {}),
+        ([('topic', 1)], {}),
+    ],
+    'tbp': [
+        ([('username', 1)], {}),
+        ([('claimed', 1)], {}),
+        ([('claimed_until', 1)], {}),
+    ],
+    'topics': [
+        ([('name', 1)], {}),
+    ],
+    'broker_tasks': [
+        ([('worker_id', 1), ('lease_until', 1)], {}),
+    ],
+    'broker_events': [
+        ([('lease_until', 1)], {}),
+    ],
+}
+
+# indexes of each messages_{id} collection
+MESSAGE_INDEXES = [
+    ([('id', 1)], {'unique': True}),
+]
+
+# representative filters of the queries issued on each collection
+QUERY_SHAPES = {
+    'groups': [
+        {'last_update': {'$lt': datetime(1970, 1, 1, tzinfo=timezone.utc)}, 'state': 'inside', 'worker_id': 0},
+        {'username': ''},
+        {'id': 0},
+        {'state': 'inside', 'topic': ''},
+        {'state': {'$in': ['joining', 'checking']}, 'lease_until': {'$lt': datetime(1970, 1, 1, tzinfo=timezone.utc)}},
+        {'updated_at': {'$gte': datetime(1970, 1, 1, tzinfo=timezone.utc)}},
+    ],
+    'seed': [
+        {'tg_link': ''},
+        {'topic': ''},
+    ],
+    'tbp': [
+        {'username': ''},
+        {'claimed': ''},
+    ],
+    'topics': [
+        {'name': ''},
+    ],
+    'broker_tasks': [
+        {'lease_until': {'$lt': datetime(1970, 1, 1, tzinfo=timezone.utc)}, 'worker_id': 0},
+    ],
+    'broker_events': [
+        {'lease_until': {'$lt': datetime(1970, 1, 1, tzinfo=timezone.utc)}},
+    ],
+}
+
+
+class IndexManager:
+    def __init__(self, db, slow_ms=100):
+        """Create and check the indexes declared in ```INDEXES```, report queries slower than ```slow_ms``` milliseconds."""
+        self.db = db
+        self.slow_ms = slow_ms
+        # message collections whose indexes have already been created by this process
+        self.message_collections = set()
+
+
+    def __create(self, collection, keys, options):
+        """Create an index, return False if it could not be created."""
+        # create_index does nothing if an identical index already exists
+        try:
+            collection.create_index(keys, **options)
+        except pymongo.errors.DuplicateKeyError:
+            if not options.get('unique'):
+                raise
+            # documents stored twice by older versions, before the index existed
+            deleted = self.deduplicate(collection, keys)
+            print(f"{datetime.now()} - [INDEXES] Deleted {deleted} duplicates of {keys} from {collection.name}")
+            return self.__create(collection, keys, options) if deleted > 0 else False
+        except pymongo.errors.OperationFailure as e:
+            print(f"{datetime.now()} - [INDEXES] [!] Could not create index {keys} on {collection.name}: {e}")
+            return False
+        return True
+
+
+    def ensure(self, collections=None):
+        """Create the indexes of the given collections (all the declared ones by default)."""
+        if collections is None:
+            collections = list(INDEXES.keys())
+        for name in collections:
+            for keys, options in INDEXES[name]:
+                self.__create(self.db[name], keys, options)
+
+
+    def ensure_messages(self, name, indexes=MESSAGE_INDEXES):
+        if name in self.message_collections:
+            return
+        created = [self.__create(self.db[name], keys, options) for keys, options in indexes]
+        # a collection whose indexes could not be created is tried again by the next writer
+        if all(created):
+            self.message_collections.add(name)
+
+
+    def deduplicate(self, collection, keys, batch_size=1000):
+        """Delete the documents of ```collection``` with the same ```keys``` as an older one, return how many were deleted."""
+        pipeline = [
+            {'$group': {'_id': {key: f'${key}' for key, _ in keys}, 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+            {'$match': {'count': {'$gt': 1}}},
+        ]
+        duplicates = []
+        for entry in collection.aggregate(pipeline, allowDiskUse=True):
+            # the first document written is kept
+            duplicates.extend(sorted(entry['ids'])[1:])
+        deleted = 0
+        for i in range(0, len(duplicates), batch_size):
+            deleted += collection.delete_many({'_id': {'$in': duplicates[i:i + batch_size]}}).deleted_count
+        return deleted
+
+
+    def verify(self, collections=None):
+        """Return the declared indexes that are missing as a list of (collection, keys)."""
+        if collections is None:
+            collections = list(INDEXES.keys())
+        missing = []
+        for name in collections:
+            existing = [[tuple(key) for key in index['key']] for index in self.db[name].index_information().values()]
+            for keys, _ in INDEXES[name]:
+                if keys not in existing:
+                    missing.append((name, keys))
+        for name, keys in missing:
+            print(f"{datetime.now()} - [INDEXES] [!] Missing index {keys} on {name}")
+        return missing
+
+
+    def __has_stage(self, plan, stage):
+        if plan.get('stage') == stage:
+            return True
+        children = plan.get('inputStages', []) + ([plan['inputStage']] if 'inputStage' in plan else [])
+        return any(self.__has_stage(child, stage) for child in children)
+
+
+    def report(self, collections=None):
+        """Print the query shapes that would scan a whole collection and the slow queries recorded by the profiler."""
+        if collections is None:
+            collections = list(QUERY_SHAPES.keys())
+        unindexed = []
+        for name in collections:
+            for query in QUERY_SHAPES.get(name, []):
+                try:
+                    plan = self.db[name].find(query).explain()['queryPlanner']['winningPlan']
+                except pymongo.errors.PyMongoError as e:
+                    print(f"{datetime.now()} - [INDEXES] [!] Could not explain query on {name}: {e}")
+                    continue
+                if self.__has_stage(plan, 'COLLSCAN'):
+                    unindexed.append((name, query))
+                    print(f"{datetime.now()} - [INDEXES] [!] Query on {name} is not indexed: {list(query.keys())}")
+        # slow queries are only available if profiling has been enabled on the database
+        try:
+            if self.db.command('profile', -1)['was'] > 0:
+                cursor = self.db['system.profile'].find({'millis': {'$gte': self.slow_ms}}).sort('ts', -1).limit(20)
+                for op in cursor:
+                    print(f"{datetime.now()} - [INDEXES] [!] Slow {op.get('op')} on {op.get('ns')} " +
+                          f"({op.get('millis')} ms, {op.get('planSummary', '')})")
+        except pymongo.errors.PyMongoError as e:
+            print(f"{datetime.now()} - [INDEXES] [!] Could not read the profiler: {e}")
+        return unindexed
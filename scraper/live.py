@@ -0,0 +1,179 @@
+from datetime import datetime
+import asyncio
+import time
+import telethon
+from telethon import events
+from telethon.tl.functions.messages import GetPeerDialogsRequest
+from telethon.tl.types import InputDialogPeer, Message, MessageService, PeerChannel, UpdateNewChannelMessage
+from util import wait_time
+from writer import MessageWriter
+
+
+class LiveStream:
+    def __init__(self, worker, watch_interval=5, verify_interval=60, batch_size=100):
+        """Write the new messages pushed by Telegram for the groups of ```worker```, in micro-batches through its write pipeline.
+        A group is streamed once a task has fetched its history; it is in sync when that fetch and the stream since then
+        were not interrupted by a disconnection (checked every ```watch_interval``` seconds). The checkpoint of a group
+        (```last_message_id```) only moves while it is in sync, so a later fetch fills the gap left by a disconnection.
+        Telethon fetches the updates missed before a newer update of the same group, the ones lost without a later update
+        (for instance during a reconnection shorter than ```watch_interval```) are found every ```verify_interval``` seconds
+        by comparing the top message of the groups in sync, ```batch_size``` groups per request, with the last one received."""
+        self.worker = worker
+        self.watch_interval = watch_interval
+        self.verify_interval = verify_interval
+        self.batch_size = batch_size
+        # incremented at every disconnection, a group is in sync if it was synced in the current epoch
+        self.epoch = 0
+        self.connected = True
+        # group id -> {username, writer, epoch, last_id, checkpoint, behind}
+        self.groups = {}
+        self.watcher = None
+
+
+    def start(self):
+        # events.NewMessage drops service messages (joins, pins, new titles), fetches store them
+        self.worker.client.add_event_handler(self.__on_message, events.Raw(UpdateNewChannelMessage))
+        self.watcher = asyncio.ensure_future(self.__watch())
+        print(f"{datetime.now()} - [LIVE n.{self.worker.pid}] Listening for new messages")
+
+
+    async def __watch(self):
+        verified = time.monotonic()
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            connected = self.worker.client.is_connected()
+            if self.connected and not connected:
+                # updates may be lost until the client is connected again
+                self.epoch += 1
+                print(f"{datetime.now()} - [LIVE n.{self.worker.pid}] [!] Disconnected, {len(self.groups)} groups will be fetched again")
+            self.connected = connected
+            if connected and time.monotonic() - verified >= self.verify_interval:
+                verified = time.monotonic()
+                try:
+                    await self.verify()
+                except Exception as e:
+                    print(f"{datetime.now()} - [LIVE n.{self.worker.pid}] [!] Could not verify the streamed groups: {e}")
+
+
+    async def verify(self):
+        """Put out of sync the groups in sync that did not receive the top message seen at the previous verification,
+        so that their next check fetches the messages lost by the stream. Return their ids."""
+        synced = [group_id for group_id, state in self.groups.items() if state['epoch'] == self.epoch]
+        lost = []
+        for i in range(0, len(synced), self.batch_size):
+            peers = {group_id: self.worker.dialogs.get(group_id) for group_id in synced[i:i + self.batch_size]}
+            peers = {group_id: peer for group_id, peer in peers.items() if peer is not None}
+            if len(peers) == 0:
+                continue
+            top_messages = await self.__top_messages(list(peers.values()))
+            for group_id in peers:
+                state = self.groups.get(group_id)
+                top = top_messages.get(group_id)
+                if state is None or top is None or state['epoch'] != self.epoch:
+                    continue
+                last_id = state['last_id'] or 0
+                if state['behind'] is not None and last_id < state['behind']:
+                    # a message older than verify_interval never arrived
+                    state['epoch'] = None
+                    lost.append(group_id)
+                # messages sent just before the request may still be on their way, they are checked next time
+                state['behind'] = top if top > last_id else None
+        if len(lost) > 0:
+            print(f"{datetime.now()} - [LIVE n.{self.worker.pid}] [!] Updates lost for {len(lost)} groups, they will be fetched again")
+            self.worker.metrics.inc('live_groups_lost_total', len(lost), "Groups put out of sync by the verification of the stream")
+        return lost
+
+
+    async def __top_messages(self, peers):
+        # the request is paced with the other requests about channels, a flood wait skips this verification
+        result = {}
+        try:
+            await self.worker.acquire('full_channel', result)
+            response = await self.worker.client(GetPeerDialogsRequest([InputDialogPeer(peer) for peer in peers]))
+            self.worker.limiter.success('full_channel')
+        except telethon.errors.FloodWaitError as e:
+            wait = wait_time(e)
+            print(f"{datetime.now()} - [LIVE n.{self.worker.pid}] [!] Flood Error: Waiting for {wait} seconds. ({e})")
+            self.worker.flood('full_channel', wait, result)
+            return {}
+        return {dialog.peer.channel_id: dialog.top_message for dialog in response.dialogs if isinstance(dialog.peer, PeerChannel)}
+
+
+    def watch(self, group_id, username):
+        """Start streaming ```group_id``` before its history is fetched, so that no message falls between the two."""
+        state = self.groups.get(group_id)
+        if state is None or state['writer'].broken:
+            collection = self.worker.store.collection(group_id)
+            state = self.groups[group_id] = {
+                'username': username,
+                'writer': MessageWriter(collection, self.worker.write_batch_size, self.worker.write_flush_interval,
+                                        on_flush=lambda last_id: self.__checkpoint(group_id, last_id)),
+                'epoch': None,
+                'last_id': None,
+                'checkpoint': None,
+                'behind': None,
+            }
+        state['username'] = username
+        return self.epoch
+
+
+    def forget(self, group_id):
+        # the account left the group, Telegram stops pushing its messages
+        self.groups.pop(group_id, None)
+
+
+    def synced(self, group_id, epoch, last_id):
+        """The history of ```group_id``` has been fetched up to ```last_id``` by a fetch started in ```epoch```."""
+        state = self.groups.get(group_id)
+        if state is None:
+            return
+        if last_id is not None:
+            state['last_id'] = max(state['last_id'] or last_id, last_id)
+            state['checkpoint'] = max(state['checkpoint'] or last_id, last_id)
+        state['epoch'] = epoch if epoch == self.epoch and last_id is not None else None
+        state['behind'] = None
+
+
+    def in_sync(self, group_id):
+        state = self.groups.get(group_id)
+        return state is not None and state['epoch'] == self.epoch and not state['writer'].broken
+
+
+    def resume_from(self, group_id, min_id):
+        """First message of the gap of ```group_id```: the last one received while it was in sync, if newer than ```min_id```."""
+        state = self.groups.get(group_id)
+        if state is None or state['checkpoint'] is None or state['writer'].broken:
+            return min_id
+        return state['checkpoint'] if min_id is None else max(min_id, state['checkpoint'])
+
+
+    async def report(self, group_id, result):
+        """Add the messages written for ```group_id``` since the last report to ```result```, as if they had been fetched."""
+        state = self.groups[group_id]
+        await self.worker.flush_messages(state['writer'], result)
+        # some messages were not stored: the next check fetches the history again
+        result['last_message_id'] = None if state['writer'].broken else state['last_id']
+
+
+    def __checkpoint(self, group_id, last_id):
+        # called by the writer thread after a flush
+        state = self.groups[group_id]
+        if state['epoch'] != self.epoch:
+            return
+        self.worker.db['groups'].update_one({'id': group_id}, {'$max': {'last_message_id': last_id}, '$currentDate': {'updated_at': True}})
+
+
+    async def __on_message(self, update):
+        message = update.message
+        if not isinstance(message, (Message, MessageService)):
+            return
+        group_id = getattr(message.peer_id, 'channel_id', None)
+        state = self.groups.get(group_id)
+        if state is None:
+            return
+        await self.worker.pipeline.put(state['writer'], self.worker.store.document(group_id, self.worker.serializer.message(message)))
+        self.worker.metrics.inc('live_messages_total', 1, "Messages received from the update stream")
+        if state['last_id'] is None or message.id > state['last_id']:
+            state['last_id'] = message.id
+            if state['epoch'] == self.epoch:
+                state['checkpoint'] = message.id
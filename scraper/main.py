@@ -1,5 +1,6 @@
 from tgstat import TGStatScraper
 from master import MonitoringMaster
+from scheduler import PollingPolicy
 from worker import MonitoringWorker
 from datetime import datetime
 
@@ -17,12 +18,13 @@ for i in range(1, len(data), 2):
     api_hash = data[i+1].rstrip()
     worker = MonitoringWorker(api_id, api_hash, connection_string, starting_date=starting_date)
     workers.append(worker)
-master = MonitoringMaster(workers, connection_string)
+# groups are checked when about 500 new messages are expected, between every hour and every 3 days
+master = MonitoringMaster(workers, connection_string, polling=PollingPolicy(target_messages=500, min_interval=1, max_interval=72))
 master.run_workers()
 
 # Initalize scraper for TGStat
 translations = {'Английский', 'Ingliz', 'Inglizcha'}
-tg_ranking = TGStatScraper('https://tgstat.com/ratings/chats', connection_string, translation_set=translations)
+tg_ranking = TGStatScraper('https://tgstat.com/ratings/chats', connection_string, translation_set=translations, metrics=master.metrics)
 
 # During the loop, ask for groups and join them
 for topic in topics:
@@ -31,12 +33,13 @@ for topic in topics:
     tg_ranking.send_to_processing(topic)
     master.crawl('join')
 
-# Check the groups every 12 hours (default value)
+# Check the groups when they are due
 while True:
     master.crawl('check')
+    # rankings of all topics are downloaded concurrently
+    tg_ranking.get_group_rankings(topics, sort='mau')
     for topic in topics:
         master.update_usernames(topic)
-        tg_ranking.get_group_ranking(topic, sort='mau')
         # tg_ranking.enrich_topic_with_language(topic)
         tg_ranking.send_to_processing(topic)
         master.crawl('join')
\ No newline at end of file
@@ -1,17 +1,26 @@
 from datetime import datetime, timedelta, timezone
 from worker import MonitoringWorker
+from scheduler import GroupScheduler
+from indexes import IndexManager
+from bulk import BulkUpdates
+from entities import EntityStore
+from metrics import Metrics
+from util import as_utc
+from collections import deque
 import multiprocessing
 import pymongo
 import queue
+import time
 
 
 class MonitoringMaster:
-    def __init__(self, workers, connection_string: str, threshold_check=12, dbname='GroupMonitoring_on_Telegram', can_join=[]):
+    def __init__(self, workers, connection_string: str, threshold_check=12, dbname='GroupMonitoring_on_Telegram', can_join=[], metrics_path='master.metrics.prom', metrics_interval=15, metrics_port=None, broker=None, task_lease=6*3600, snapshot_path='scheduler.snapshot.json', maintenance_interval=60, polling=None, rebalance_interval=None):
 
         self.n_processes = len(workers)
         self.workers = workers
         self.processes = []
-        self.busy = [False for _ in range(self.n_processes)]
+        # number of tasks in flight for each worker
+        self.busy = [0 for _ in range(self.n_processes)]
 
         try:
             print(f"{datetime.now()} - [MASTER]: Opening mongodb connection...")
@@ -20,28 +29,70 @@ class MonitoringMaster:
         except Exception as e:
             print(f"{datetime.now()} - [!] Error in opening database connection: {e}")
             exit(-1)
+        print(f"{datetime.now()} - [MASTER]: Checking indexes...")
+        self.indexes = IndexManager(self.db)
+        self.indexes.ensure(['groups', 'tbp'])
+        self.indexes.verify(['groups', 'tbp'])
+        self.indexes.report(['groups', 'tbp'])
         print(f"{datetime.now()} - [MASTER]: Creating leave queues, wait queues, " +
               "processes queue, task list")
-        self.result_queue = multiprocessing.Queue()
-        self.process_queue = multiprocessing.Queue()
+        # workers send both their results and their free slots on this queue;
+        # with a broker (see broker.MongoBroker) tasks and events go through MongoDB and workers can run on other hosts
+        self.broker = broker
+        if broker is None:
+            self.events = multiprocessing.Queue()
+        else:
+            broker.ensure_indexes()
+            broker.recover(self.n_processes)
+            self.events = broker.events()
+        # ids of the workers with a free slot, one entry for each slot
+        self.free = deque()
         # self.tasks = multiprocessing.Queue()
         self.tasks = []
-        self.process_queue_timeout = 3
+        # tasks of each worker dispatched before any other one as soon as it has a free slot (moves of groups)
+        self.pending = [deque() for _ in range(self.n_processes)]
+        # with a rebalance_interval (seconds) groups are moved from the busiest accounts to the least busy ones
+        self.rebalance_interval = rebalance_interval
+        self.next_rebalance = None
         self.threshold_check = threshold_check
+        # state of the groups is loaded in memory the first time crawl() is called, from snapshot_path if it exists;
+        # with a polling policy (scheduler.PollingPolicy) groups are checked according to their message rate instead of every threshold_check hours
+        self.scheduler = GroupScheduler(self.db, self.n_processes, threshold_check, snapshot_path=snapshot_path, policy=polling)
+        # groups stay joining or checking for at most task_lease seconds, then their task is considered lost;
+        # expired leases are reclaimed and the snapshot is saved every maintenance_interval seconds
+        self.task_lease = task_lease
+        self.maintenance_interval = maintenance_interval
+        self.next_maintenance = None
+        # full channels are stored once for each distinct content, groups only keep a reference
+        self.entities = EntityStore(self.db)
         if len(can_join) == 0:
             self.can_join = [True for _ in range(self.n_processes)]
         else:
             self.can_join = can_join
+        # metrics are written to metrics_path and, if metrics_port is given, served on http://127.0.0.1:<port>/metrics
+        self.metrics = Metrics()
+        self.metrics.collect(self.__collect_metrics)
+        if metrics_path is not None:
+            self.metrics.start_file(metrics_path, metrics_interval)
+        if metrics_port is not None:
+            self.metrics.serve(metrics_port)
 
 
     def run_workers(self):
         # Create and start worker process
         print(f"{datetime.now()} - [MASTER]: Launching workers... ")
         for i, worker in enumerate(self.workers):
+            self.tasks.append(multiprocessing.Queue() if self.broker is None else self.broker.tasks(i))
+            if worker is None:
+                # started on another host with remote.py, it may still be running the tasks of a previous run
+                slots = self.broker.free_slots(i)
+                self.free.extend(i for _ in range(slots))
+                self.busy[i] = self.tasks[i].qsize()
+                print(f"{datetime.now()} - [MASTER]: Worker {i} is expected to connect to the broker ({slots} free slots)")
+                continue
+            self.free.append(i)
             # start new process
-            self.process_queue.put(i)
-            self.tasks.append(multiprocessing.Queue())
-            worker.bind(i, self.tasks[i], self.result_queue, self.process_queue)
+            worker.bind(i, self.tasks[i], self.events)
             process = multiprocessing.Process(target=worker.launch_client)
             process.start()
             self.processes.append(process)
@@ -57,151 +108,393 @@ class MonitoringMaster:
             update_until = datetime.now(tz=timezone.utc) + timedelta(hours=tdelta)
         message = 'join and check' if assign_task == 'both' else assign_task
         print(f"{datetime.now()} - [MASTER] Starting to {message} groups")
-        x = self.db['tbp'].find_one()
-        just_checked_results = False
+        if not self.scheduler.loaded:
+            self.scheduler.load()
+            if self.broker is None:
+                # local workers are started by this master, no task of a previous run can still be running
+                self.reclaim(expired_only=False)
+        self.maintain()
+        x = self.scheduler.peek_tbp()
+        # workers with a free slot but nothing to do, they are tried again after the next event
+        idle = []
         while x is not None or assign_task == 'check':
             if assign_task == 'check' and datetime.now(tz=timezone.utc) > update_until:
                 break
-            if just_checked_results or not self.process_queue.empty():
-                try:
-                    worker_id = self.process_queue.get(timeout=self.process_queue_timeout)
-                except queue.Empty:
-                    just_checked_results = False
-                    continue
+            if datetime.now(tz=timezone.utc) >= self.next_maintenance:
+                self.maintain()
+            if len(self.free) == 0:
+                # block until a worker sends an event, a group of an idle worker is due or maintenance is due
+                deadline = self.__next_due(idle, assign_task)
+                if assign_task == 'check' and (deadline is None or update_until < deadline):
+                    deadline = update_until
+                if deadline is None or self.next_maintenance < deadline:
+                    deadline = self.next_maintenance
+                timeout = None if deadline is None else max(0, (deadline - datetime.now(tz=timezone.utc)).total_seconds())
+                self.get_results(block=True, timeout=timeout)
+                self.free.extend(idle)
+                idle = []
+                continue
+            worker_id = self.free.popleft()
 
-                # try to assign task CHECK_WAIT
-                task = {
-                    'name': 'CHECK_WAIT',
-                    'data': []
+            # moves of groups planned by rebalance()
+            task = self.__pop_pending(worker_id)
+            if task is not None:
+                self.__dispatch(worker_id, task)
+                print(f"{datetime.now()} - [MASTER] Assigning task {task['name']} for group {task['data']['username']}")
+                self.get_results()
+                continue
+
+            # try to assign task CHECK_WAIT
+            task = {
+                'name': 'CHECK_WAIT',
+                'data': []
+            }
+            # check if any groups for which a request was sent can be checked
+            group = self.scheduler.pop_due('waiting', worker_id)
+            # if possible, assign the CHECK_WAIT task
+            if group is not None:
+                task['data'] = {
+                    'username': group['username'],
+                    'id': group['id'],
+                    'min_id': group['last_message_id']
                 }
-                # check if any groups for which a request was sent can be checked
-                date_threshold = datetime.now(tz=timezone.utc) - timedelta(hours=self.threshold_check)
-                group = self.db['groups'].find_one({'last_update': {'$lt': date_threshold}, 'state': 'waiting', 'worker_id': worker_id}, sort={'last_update': 1})
-                # if possible, assign the CHECK_WAIT task
-                if group is not None:
-                    task['data'] = {
-                        'username': group['username'],
-                        'id': group['id']
-                    }
-                    self.db['groups'].update_one(
-                        {'username': group['username']},
-                        {'$set': {'state': 'joining'}}
-                    )
-                    self.tasks[worker_id].put(task)
-                    self.busy[worker_id] = True
-                    print(f"{datetime.now()} - [MASTER] Assigning task {task['name']} for a group you already sent a request to")
-                    # after assigning a task, get results
-                    just_checked_results = True
-                    self.get_results()
-                    continue
+                self.db['groups'].update_one(
+                    {'username': group['username']},
+                    {'$set': {'state': 'joining', 'lease_until': self.__lease()}, '$currentDate': {'updated_at': True}}
+                )
+                self.scheduler.update(group['username'], state='joining')
+                self.__dispatch(worker_id, task)
+                print(f"{datetime.now()} - [MASTER] Assigning task {task['name']} for a group you already sent a request to")
+                # after assigning a task, get results
+                self.get_results()
+                continue
+
+            # try to assign task CHECK_UPDATES
+            task = {
+                'name': 'CHECK_UPDATES',
+                'data': []
+            }
+            # check if any groups can be checked
+            group = None
+            if assign_task != 'join' or not self.can_join[worker_id]:
+                group = self.scheduler.pop_due('inside', worker_id)
+            # if possible, assign the CHECK_UPDATES task
+            if group is not None:
+                task['data'] = {
+                    'id': group['id'],
+                    'username': group['username'],
+                    'offset_date': group['last_update'],
+                    'min_id': group['last_message_id']
+                }
+                self.db['groups'].update_one(
+                    {'id': group['id']},
+                    {'$set': {'state': 'checking', 'lease_until': self.__lease()}, '$currentDate': {'updated_at': True}})
+                self.scheduler.update(group['username'], state='checking')
+                self.__dispatch(worker_id, task)
+                print(f"{datetime.now()} - [MASTER] Assigning task {task['name']}")
+                # after assigning a task, get results
+                self.get_results()
+                continue
 
-                # try to assign task CHECK_UPDATES
+            # assign task TRY_JOIN for groups you have not asked to be accepted in yet
+            if assign_task != 'check' and self.can_join[worker_id] and not self.__lightest(worker_id, x):
+                # another account expects fewer messages, the group is left to it
+                idle.append(worker_id)
+                self.get_results()
+                continue
+            if assign_task != 'check' and self.can_join[worker_id]:
                 task = {
-                    'name': 'CHECK_UPDATES',
+                    'name': 'TRY_JOIN',
                     'data': []
                 }
-                # check if any groups can be checked
-                date_threshold = datetime.now(tz=timezone.utc) - timedelta(hours=self.threshold_check)
-                group = self.db['groups'].find_one({'last_update': {'$lt': date_threshold}, 'state': 'inside', 'worker_id': worker_id}, sort={'last_update': 1})
-                # if possible, assign the CHECK_UPDATES task
-                if group is not None and (assign_task != 'join' or not self.can_join[worker_id]):
+                # groups already in the groups collection are skipped by the scheduler
+                x = self.scheduler.pop_tbp()
+                if x is not None:
+                    # assign task
                     task['data'] = {
-                        'id': group['id'],
-                        'username': group['username'],
-                        'offset_date': group['last_update']
+                        'username': x['username'],
+                        'min_id': x.get('last_message_id')
                     }
-                    self.db['groups'].update_one(
-                        {'id': group['id']},
-                        {'$set': {'state': 'checking'}})
-                    self.tasks[worker_id].put(task)
-                    self.busy[worker_id] = True
+                    self.__dispatch(worker_id, task)
+                    # update x
+                    x['state'] = 'joining'
+                    x['last_update'] = datetime.now(tz=timezone.utc)
+                    x['worker_id'] = worker_id
+                    x['lease_until'] = self.__lease()
+                    x['updated_at'] = x['last_update']
+                    # update db
+                    self.db['groups'].insert_one(x)
+                    self.scheduler.track({'username': x['username'], 'state': 'joining', 'worker_id': worker_id, 'last_update': x['last_update'],
+                                          'last_message_id': x.get('last_message_id'), 'number_of_messages': x.get('number_of_messages')})
+                    self.db['tbp'].delete_many({'username': x['username']})
                     print(f"{datetime.now()} - [MASTER] Assigning task {task['name']}")
                     # after assigning a task, get results
-                    just_checked_results = True
                     self.get_results()
+                    x = self.scheduler.peek_tbp()
                     continue
-
-                # assign task TRY_JOIN for groups you have not asked to be accepted in yet
-                if assign_task != 'check' and self.can_join[worker_id]:
-                    task = {
-                        'name': 'TRY_JOIN',
-                        'data': []
-                    }
-                    x = self.db['tbp'].find_one({})
-                    if x is not None:
-                        if self.db['groups'].find_one({'username': x['username']}) is None:
-                            # assign task
-                            task['data'] = {
-                                'username': x['username']
-                            }
-                            self.tasks[worker_id].put(task)
-                            self.busy[worker_id] = True
-                            # update x
-                            x['state'] = 'joining'
-                            x['last_update'] = datetime.now(tz=timezone.utc)
-                            x['worker_id'] = worker_id
-                            # update db
-                            x.pop('_id', None)
-                            self.db['groups'].insert_one(x)
-                            print(f"{datetime.now()} - [MASTER] Assigning task {task['name']}")
-                            # after assigning a task, get results
-                            just_checked_results = True
-                            self.get_results()
-                        self.db['tbp'].delete_many({'username': x['username']})
-                        continue
-                    else:
-                        self.process_queue.put(worker_id)
-                        # no groups need to be joined: exit
-                        break
-                # no task assigned: put process back in process queue and check results
-                self.process_queue.put(worker_id)
-                just_checked_results = True
-                self.get_results()
-            else:
-                just_checked_results = True
-                self.get_results()
+                else:
+                    self.free.appendleft(worker_id)
+                    # no groups need to be joined: exit
+                    break
+            # no task assigned: the worker waits for the next event
+            idle.append(worker_id)
+            self.get_results()
+        self.free.extend(idle)
+        self.scheduler.save()
         print(f"{datetime.now()} - [MASTER]: tbp collection is empty or check interval has expired, stopping crawling")
     
 
-    def update_usernames(self, topic='all'):
+    def update_usernames(self, topic='all', batch_size=100, bots_interval=7):
+        """Check the usernames of the groups the workers are in, ```batch_size``` groups for each ```CHECK_USERNAMES``` task.
+        The full channel (with its bots) is only fetched for groups whose username changed or whose bots were
+        checked more than ```bots_interval``` days ago."""
         if topic == 'all':
             query = {'state': 'inside'}
         else:
             query = {'state': 'inside', 'topic': topic}
-        cursor = self.db['groups'].find(query)
+        # only the fields needed to build the batches are read
+        cursor = self.db['groups'].find(query, projection={'_id': 0, 'id': 1, 'username': 1, 'worker_id': 1, 'bots_checked': 1})
+        stale = datetime.now(tz=timezone.utc) - timedelta(days=bots_interval)
 
         finished = [False for _ in range(self.n_processes)]
-        worker_groups = [[] for _ in range(self.n_processes)]
+        # slots taken by workers with no groups left
+        parked = []
+        batches = [deque() for _ in range(self.n_processes)]
+        current = [[] for _ in range(self.n_processes)]
         for group in cursor:
-            worker_id = group['worker_id']
-            worker_groups[worker_id].append(group)
-        
+            worker_id = group.get('worker_id')
+            if worker_id is None or not 0 <= worker_id < self.n_processes:
+                continue
+            bots_checked = as_utc(group.get('bots_checked'))
+            current[worker_id].append({
+                'id': group['id'],
+                'username': group['username'],
+                'full': bots_checked is None or bots_checked < stale
+            })
+            if len(current[worker_id]) == batch_size:
+                batches[worker_id].append(current[worker_id])
+                current[worker_id] = []
+        for worker_id, batch in enumerate(current):
+            if len(batch) > 0:
+                batches[worker_id].append(batch)
+
         while not all(finished):
-            worker_id = self.process_queue.get()
-            if len(worker_groups[worker_id]) == 0:
+            worker_id = self.__next_free()
+            if len(batches[worker_id]) == 0:
                 finished[worker_id] = True
+                parked.append(worker_id)
                 continue
-            group = worker_groups[worker_id].pop(0)
             task = {
-                'name': 'CHECK_USERNAME',
-                'data': {}
-            }
-            task['data'] = {
-                'username': group['username'],
-                'id': group['id']
+                'name': 'CHECK_USERNAMES',
+                'data': {'groups': batches[worker_id].popleft()}
             }
             print(f"{datetime.now()} - [MASTER] Assigning task {task['name']}")
-            self.tasks[worker_id].put(task)
+            self.__dispatch(worker_id, task)
             self.get_results()
         self.get_results()
-        for i in range(self.n_processes):
-            self.process_queue.put(i)
+        # give back the slots, workers still running tasks give back theirs when done
+        self.free.extend(parked)
+
+
+    def __lease(self):
+        return datetime.now(tz=timezone.utc) + timedelta(seconds=self.task_lease)
+
+
+    def maintain(self):
+        """Reclaim the groups whose lease expired and save the snapshot of the scheduler."""
+        self.reclaim()
+        now = datetime.now(tz=timezone.utc)
+        if self.rebalance_interval is not None and (self.next_rebalance is None or now >= self.next_rebalance):
+            self.rebalance()
+            self.next_rebalance = now + timedelta(seconds=self.rebalance_interval)
+        self.scheduler.save()
+        self.next_maintenance = now + timedelta(seconds=self.maintenance_interval)
+
 
+    def __lightest(self, worker_id, entry):
+        # joins go to the account with the lowest expected volume of messages among those with a free slot, or to one
+        # that is not much busier; busy accounts are not waited for, a backfill can keep them busy for hours
+        if entry is None:
+            return True
+        candidates = {worker_id} | {i for i in self.free if self.can_join[i]}
+        lightest = min(self.scheduler.volume[i] for i in candidates)
+        return self.scheduler.volume[worker_id] <= lightest + self.scheduler.rate(entry)
 
-    def get_results(self, block=False):
-        while not self.result_queue.empty() or block:
-            result = self.result_queue.get()
+
+    def rebalance(self, tolerance=1.5, max_moves=10):
+        """Plan up to ```max_moves``` moves of groups from the account expecting the most messages to the one expecting
+        the least, until the busiest one expects at most ```tolerance``` times the messages of the least busy one.
+        The new account joins the group (```MOVE_JOIN```), then the old one leaves it (```LEAVE```)."""
+        volume = list(self.scheduler.volume)
+        targets = [i for i in range(self.n_processes) if self.can_join[i]]
+        if len(targets) == 0:
+            return 0
+        moves = 0
+        while moves < max_moves:
+            busiest = max(range(self.n_processes), key=lambda i: volume[i])
+            lightest = min(targets, key=lambda i: volume[i])
+            gap = volume[busiest] - volume[lightest]
+            if busiest == lightest or volume[busiest] <= tolerance * volume[lightest]:
+                break
+            # the busiest group whose move narrows the gap
+            group = next((group for group in self.scheduler.movable(busiest) if 0 < self.scheduler.rate(group) < gap), None)
+            if group is None:
+                break
+            group['moving'] = lightest
+            volume[busiest] -= self.scheduler.rate(group)
+            volume[lightest] += self.scheduler.rate(group)
+            self.pending[lightest].append({
+                'name': 'MOVE_JOIN',
+                'data': {'username': group['username'], 'id': group['id'], 'from_worker': busiest}
+            })
+            moves += 1
+            print(f"{datetime.now()} - [MASTER] Moving group {group['username']} from worker {busiest} to worker {lightest}")
+        return moves
+
+
+    def __pop_pending(self, worker_id):
+        # next pending task of the worker, a group is not left while it is being checked
+        for _ in range(len(self.pending[worker_id])):
+            task = self.pending[worker_id].popleft()
+            group = self.scheduler.get(id=task['data']['id'])
+            if task['name'] == 'LEAVE' and group is not None and group['state'] == 'checking':
+                self.pending[worker_id].append(task)
+                continue
+            return task
+        return None
+
+
+    def reclaim(self, expired_only=True):
+        """Give back the groups left ```joining``` or ```checking``` by a task whose lease expired (the master or
+        the worker died), or by any task if not ```expired_only```: checked groups are checked again, groups never
+        joined go back to ```tbp```.
+        Messages the lost task already stored are not fetched again: the next task resumes from the ```last_message_id```
+        checkpointed on the group."""
+        now = datetime.now(tz=timezone.utc)
+        # groups set by older versions have no lease
+        query = {'state': {'$in': ['joining', 'checking']}}
+        if expired_only:
+            query['$or'] = [{'lease_until': {'$lt': now}}, {'lease_until': None}]
+        reclaimed = 0
+        for group in self.db['groups'].find(query, projection={'_id': 1, 'username': 1, 'id': 1, 'state': 1, 'last_message_id': 1}):
+            if group['state'] == 'checking' or group.get('id') not in (None, ""):
+                # CHECK_UPDATES or CHECK_WAIT
+                state = 'inside' if group['state'] == 'checking' else 'waiting'
+                self.db['groups'].update_one(
+                    {'_id': group['_id'], 'state': group['state']},
+                    {'$set': {'state': state}, '$unset': {'lease_until': ''}, '$currentDate': {'updated_at': True}}
+                )
+                # the checkpoint written by the worker may be ahead of the one the scheduler has in memory
+                fields = {'state': state}
+                if group.get('last_message_id') is not None:
+                    fields['last_message_id'] = group['last_message_id']
+                self.scheduler.update(group['username'], id=group.get('id') or None, **fields)
+            else:
+                # TRY_JOIN: the group is joined again, its last_message_id is kept so the fetch resumes from it
+                entry = self.db['groups'].find_one_and_delete({'_id': group['_id'], 'state': 'joining'})
+                if entry is None:
+                    continue
+                for field in ('_id', 'state', 'worker_id', 'last_update', 'lease_until', 'updated_at'):
+                    entry.pop(field, None)
+                self.db['tbp'].insert_one(entry)
+                self.scheduler.forget(group['username'])
+            reclaimed += 1
+        if reclaimed > 0:
+            print(f"{datetime.now()} - [MASTER] Reclaimed {reclaimed} groups whose task was lost")
+            self.metrics.inc('groups_reclaimed_total', reclaimed, "Groups whose task was lost and was given back")
+        return reclaimed
+
+
+    def __dispatch(self, worker_id, task):
+        # the worker measures how long the task waited in its queue
+        task['dispatched'] = time.time()
+        self.tasks[worker_id].put(task)
+        self.busy[worker_id] += 1
+        self.metrics.inc('tasks_dispatched_total', 1, "Tasks sent to the workers", task=task['name'], worker=worker_id)
+
+
+    def __collect_metrics(self, metrics):
+        metrics.set('free_slots', len(self.free), "Worker slots waiting for a task")
+        for worker_id, busy in enumerate(self.busy):
+            metrics.set('tasks_in_flight', busy, "Tasks dispatched and not completed yet", worker=worker_id)
+        try:
+            metrics.set('events_queue_size', self.events.qsize(), "Results and free slots not handled yet")
+        except NotImplementedError:
+            pass
+        metrics.set('tbp_claimed', len(self.scheduler.tbp), "Groups to be joined claimed by the master")
+        metrics.set('groups_tracked', len(self.scheduler.groups), "Groups in the scheduler")
+
+
+    def __record(self, result):
+        # counters and time breakdown of a completed task
+        worker_id = result['worker_id']
+        task = result.get('task', '')
+        self.metrics.inc('tasks_total', 1, "Completed tasks", task=task, code=result['code'], worker=worker_id)
+        self.metrics.inc('messages_total', result['messages'], "Messages collected", worker=worker_id)
+        self.metrics.inc('failed_messages_total', result['failed_messages'], "Messages that could not be stored", worker=worker_id)
+        self.metrics.inc('flood_wait_seconds_total', result.get('flood_wait', 0), "Seconds Telegram asked each account to wait", worker=worker_id)
+        for name, seconds in result.get('spans', {}).items():
+            self.metrics.observe('task_span_seconds', seconds, "Time spent by tasks in each phase", task=task, span=name)
+
+
+    def __next_free(self):
+        # wait for a worker to free a slot
+        while len(self.free) == 0:
+            self.get_results(block=True)
+        return self.free.popleft()
+
+
+    def __next_due(self, idle, assign_task):
+        # earliest time one of the idle workers will have a group to check, None if they have none
+        deadline = None
+        for worker_id in idle:
+            states = ['waiting']
+            if assign_task != 'join' or not self.can_join[worker_id]:
+                states.append('inside')
+            for state in states:
+                due = self.scheduler.next_time(state, worker_id)
+                if due is not None and (deadline is None or due < deadline):
+                    deadline = due
+        return deadline
+
+
+    def __move_cursor(self, group, result):
+        # the next fetch of the group starts after the last message collected
+        if group is not None and result['last_message_id'] is not None:
+            if group['last_message_id'] is None or result['last_message_id'] > group['last_message_id']:
+                group['last_message_id'] = result['last_message_id']
+
+
+    def __snapshot(self, username, entity, timestamp, update):
+        # add to update the new snapshot of the full channel, if its content changed
+        group = self.scheduler.get(username)
+        change = self.entities.record(None if group is None else group['entity_hash'], entity, timestamp)
+        if change is None:
+            return
+        for operator, fields in change.items():
+            update.setdefault(operator, {}).update(fields)
+        if group is not None:
+            group['entity_hash'] = change['$set']['entity_hash']
+
+
+    def get_results(self, block=False, timeout=None):
+        """Handle the events sent by the workers: results are applied and freed slots are added to ```free```.
+        If ```block``` is True wait up to ```timeout``` seconds (forever if None) for the first event.
+        The updates of all the handled results are sent to the database with a single bulk_write."""
+        # the scheduler reads back the groups updated since its last snapshot
+        updates = BulkUpdates(self.db['groups'], touch='updated_at')
+        while True:
+            try:
+                kind, result = self.events.get(timeout=timeout) if block else self.events.get_nowait()
+            except queue.Empty:
+                break
+            # once the first event has been received, only drain the ones already available
+            block = False
+            if kind == 'FREE':
+                self.free.append(result)
+                continue
             print(f"{datetime.now()} [MASTER] Getting result for the username {result['username']} with code {result['code']}")
+            self.__record(result)
 
             if result['code'] == "JOIN_SUCCESS":
                 n_messages = result['messages']
@@ -209,85 +502,123 @@ class MonitoringMaster:
                 # change state to inside
                 # WARNING: collection may not exists if no messages were found in the group
                 # unlikely if the mau criteria is used
-                self.db['groups'].update_one(
-                    {'username': result['username']},
-                    {
-                        '$set': {'messages': {'timestamp': result['timestamp'], 'n_messages': result['messages'], 'first': True},
-                                 'state': 'inside', 'id': result['id'],
-                                 'last_update': result['timestamp'],
-                                 'first_message_date': result['first_message'],
-                                 'collection_name': f"messages_{result['id']}"}
-                    })
+                update = {'messages': {'timestamp': result['timestamp'], 'n_messages': result['messages'], 'n_failed': result['failed_messages'], 'first': True},
+                          'state': 'inside', 'id': result['id'],
+                          'last_update': result['timestamp'],
+                          'first_message_date': result['first_message'],
+                          'collection_name': result.get('collection_name', f"messages_{result['id']}")}
+                update = {'$set': update}
                 if 'full_entity' in result:
-                    self.db['groups'].update_one(
-                        {'username': result['username']},
-                        {'$set': {'full_entity': result['full_entity']}}
-                    )
+                    update['$set']['bots_checked'] = result['timestamp']
+                    self.__snapshot(result['username'], result['full_entity'], result['timestamp'], update)
+                if result['last_message_id'] is not None:
+                    update['$max'] = {'last_message_id': result['last_message_id']}
+                # first estimate of the message rate, from the messages collected when joining
+                rate = self.scheduler.observe(self.scheduler.get(result['username']), n_messages, result['first_message'], result['timestamp'])
+                if rate is not None:
+                    update['$set']['message_rate'] = rate
+                updates.update_one({'username': result['username']}, update)
+                group = self.scheduler.update(result['username'], state='inside', id=result['id'], last_update=result['timestamp'])
+                self.__move_cursor(group, result)
 
             elif result['code'] == "UPDATE_SUCCESS":
                 n_messages = result['messages']
                 # change state to inside, add record to update_date
-                self.db['groups'].update_one(
-                    {'id': result['id']},
-                    {
-                        '$set': {'last_update': result['timestamp'], 'state': 'inside'},
-                        '$push': {'update_date': {'timestamp': result['timestamp'], 'n_messages': n_messages}}
-                    })
+                update = {
+                    '$set': {'last_update': result['timestamp'], 'state': 'inside'},
+                    '$push': {'update_date': {'timestamp': result['timestamp'], 'n_messages': n_messages, 'n_failed': result['failed_messages']}}
+                }
+                if result['last_message_id'] is not None:
+                    update['$max'] = {'last_message_id': result['last_message_id']}
+                # messages found since the previous check decide when the group is checked next
+                group = self.scheduler.get(id=result['id'])
+                if group is not None:
+                    rate = self.scheduler.observe(group, n_messages, group['last_update'], result['timestamp'])
+                    if rate is not None:
+                        update['$set']['message_rate'] = rate
+                updates.update_one({'id': result['id']}, update)
+                group = self.scheduler.update(id=result['id'], state='inside', last_update=result['timestamp'])
+                self.__move_cursor(group, result)
                 print(f"{datetime.now()} - [MASTER] New messages found in group {result['username']}: {n_messages}")
             
             elif result['code'] == "REQUEST_SENT":
                 # change state to waiting, add record to update_date
-                self.db['groups'].update_one(
-                    {'username': result['username']},
-                    {
-                        '$set': {'state': 'waiting', 'last_update': result['timestamp'], 'id': result['id']},
-                        '$push': {'error_messages': {'timestamp': result['timestamp'], 'message': result['error_messages']}}
-                    }
-                )
+                update = {
+                    '$set': {'state': 'waiting', 'last_update': result['timestamp'], 'id': result['id']},
+                    '$push': {'error_messages': {'timestamp': result['timestamp'], 'message': result['error_messages']}}
+                }
                 if 'full_entity' in result:
-                    self.db['groups'].update_one(
-                        {'username': result['username']},
-                        {'$set': {'full_entity': result['full_entity']}}
-                    )
+                    update['$set']['bots_checked'] = result['timestamp']
+                    self.__snapshot(result['username'], result['full_entity'], result['timestamp'], update)
+                updates.update_one({'username': result['username']}, update)
+                self.scheduler.update(result['username'], state='waiting', id=result['id'], last_update=result['timestamp'])
                 print(f"{datetime.now()} - [MASTER] Waiting to be approved in group {result['username']}")
             
-            elif result['code'] == "ENTITY_FOUND":
-                new_entity = result['new_entity']
-                new_username = result['new_entity']['chats'][0]['username']
-                old_username = result['username']
-                if new_username != old_username:
-                    self.db['groups'].update_one(
-                        {'username': result['username']},
-                        {
-                            '$push': {'old_usernames': {'date_updated': result['timestamp'], 'username': old_username}},
-                            '$set': {'username': new_username}
-                        }
-                    )
-                    print(f"{datetime.now()} - [MASTER] Username {old_username} updated to {new_username}")
-                old_entity = self.db['groups'].find_one({'username': new_username})['full_entity']
-                old_bots = {entity['id'] for entity in old_entity['users']}
-                new_bots = {entity['id'] for entity in new_entity['users']}
-                bot_diff = new_bots.difference(old_bots)
-                for bot in new_entity['users']:
-                    if bot['id'] in bot_diff:
-                        self.db['groups'].update_one({'username': new_username}, {'$push': {'full_entity.users': bot}})
+            elif result['code'] == "ENTITIES_FOUND":
+                for entry in result['entities']:
+                    update = {}
+                    if 'new_entity' in entry:
+                        update['$set'] = {'bots_checked': result['timestamp']}
+                        self.__snapshot(entry['username'], entry['new_entity'], result['timestamp'], update)
+                    old_username = entry['username']
+                    new_username = entry['new_username']
+                    if new_username is not None and new_username != old_username:
+                        update['$push'] = {'old_usernames': {'date_updated': result['timestamp'], 'username': old_username}}
+                        update.setdefault('$set', {})['username'] = new_username
+                        self.scheduler.update(old_username, new_username=new_username)
+                        print(f"{datetime.now()} - [MASTER] Username {old_username} updated to {new_username}")
+                    if len(update) > 0:
+                        updates.update_one({'id': entry['id']}, update)
+                if len(result['missing']) > 0:
+                    print(f"{datetime.now()} - [MASTER] [!] Worker {result['worker_id']} is not in the groups {result['missing']} anymore")
+
+            elif result['code'] == "MOVE_SUCCESS":
+                # the group is checked by the new worker from now on, the old one leaves it
+                updates.update_one(
+                    {'id': result['id']},
+                    {
+                        '$set': {'worker_id': result['worker_id']},
+                        '$push': {'moves': {'timestamp': result['timestamp'], 'from': result['from_worker'], 'to': result['worker_id']}}
+                    }
+                )
+                group = self.scheduler.update(id=result['id'], worker_id=result['worker_id'])
+                if group is not None:
+                    group.pop('moving', None)
+                self.pending[result['from_worker']].append({'name': 'LEAVE', 'data': {'username': result['username'], 'id': result['id']}})
+                print(f"{datetime.now()} - [MASTER] Group {result['username']} moved from worker {result['from_worker']} to worker {result['worker_id']}")
+
+            elif result['code'] == "MOVE_FAILED":
+                group = self.scheduler.get(id=result['id'])
+                if group is not None:
+                    group.pop('moving', None)
+                print(f"{datetime.now()} - [MASTER] [!] Worker {result['worker_id']} could not join group {result['username']}: {result['error_messages']}")
+
+            elif result['code'] == "LEFT":
+                print(f"{datetime.now()} - [MASTER] Worker {result['worker_id']} left group {result['username']}")
+
+            elif result['code'] == "LEAVE_FAILED":
+                print(f"{datetime.now()} - [MASTER] [!] Worker {result['worker_id']} could not leave group {result['username']}: {result['error_messages']}")
 
             elif result['code'] == "FAILURE":
                 print(f"{datetime.now()} - [MASTER] Task failed for the username {result['username']}: {result['error_messages']}")
                 # change state to failed
-                self.db['groups'].update_one(
+                updates.update_one(
                     {'username': result['username']},
                     {
                         '$set': {'state': 'failed', 'last_update': result['timestamp']},
                         '$push': {'error_messages': {'timestamp': result['timestamp'], 'message': result['error_messages']}}
                     }
                 )
+                self.scheduler.update(result['username'], state='failed', last_update=result['timestamp'])
                 # log error messages
                 file = open('log.txt', 'a')
                 file.write(f"{datetime.now()} - {result['error_messages']}\n")
                 file.close()
             
-            self.busy[result['worker_id']] = False
-            # return if get_result is blocking
-            if block:
-                return
\ No newline at end of file
+            self.busy[result['worker_id']] -= 1
+        if len(updates) > 0:
+            with self.metrics.time('db_seconds', "Duration of database operations", operation='results_bulk_write'):
+                updates.flush()
+        if self.broker is not None:
+            # events are removed from the broker once their updates are saved
+            self.events.ack()
@@ -0,0 +1,174 @@
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import threading
+import time
+
+
+# upper bounds (seconds) of the histogram buckets
+BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+
+
+def _labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join(f'{key}="{str(value)}"' for key, value in labels) + '}'
+
+
+class Metrics:
+    def __init__(self, prefix='tgmonitor', buckets=BUCKETS):
+        """Counters, gauges and histograms of a process, rendered in the Prometheus text format.
+        Metrics are created the first time they are used; ```collect()``` registers functions that
+        refresh gauges right before the metrics are rendered."""
+        self.prefix = prefix
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # name -> (type, help), (name, labels) -> value or [bucket counts, sum, count]
+        self.types = {}
+        self.values = {}
+        self.collectors = []
+        self.threads = []
+
+
+    def __key(self, name, kind, help, labels):
+        if name not in self.types:
+            self.types[name] = (kind, help)
+        return (name, tuple(sorted(labels.items())))
+
+
+    def inc(self, name, value=1, help='', **labels):
+        with self.lock:
+            key = self.__key(name, 'counter', help, labels)
+            self.values[key] = self.values.get(key, 0) + value
+
+
+    def set(self, name, value, help='', **labels):
+        with self.lock:
+            key = self.__key(name, 'gauge', help, labels)
+            self.values[key] = value
+
+
+    def observe(self, name, value, help='', **labels):
+        with self.lock:
+            key = self.__key(name, 'histogram', help, labels)
+            if key not in self.values:
+                self.values[key] = [[0 for _ in self.buckets], 0, 0]
+            counts, _, _ = histogram = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+
+    @contextmanager
+    def time(self, name, help='', **labels):
+        """Observe the seconds spent in the ```with``` block in histogram ```name```."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, help, **labels)
+
+
+    def collect(self, function):
+        self.collectors.append(function)
+
+
+    def render(self):
+        for function in self.collectors:
+            try:
+                function(self)
+            except Exception as e:
+                print(f"{datetime.now()} - [METRICS] [!] Collector failed: {e}")
+        lines = []
+        with self.lock:
+            for name, (kind, help) in sorted(self.types.items()):
+                full_name = f"{self.prefix}_{name}"
+                if help:
+                    lines.append(f"# HELP {full_name} {help}")
+                lines.append(f"# TYPE {full_name} {kind}")
+                for (key_name, labels), value in sorted(self.values.items(), key=lambda item: str(item[0])):
+                    if key_name != name:
+                        continue
+                    if kind != 'histogram':
+                        lines.append(f"{full_name}{_labels(labels)} {value}")
+                        continue
+                    counts, total, count = value
+                    cumulative = 0
+                    for bound, n in zip(self.buckets, counts):
+                        cumulative += n
+                        lines.append(f"{full_name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+                    lines.append(f"{full_name}_bucket{_labels(labels + (('le', '+Inf'),))} {count}")
+                    lines.append(f"{full_name}_sum{_labels(labels)} {total}")
+                    lines.append(f"{full_name}_count{_labels(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+
+    def write(self, path):
+        with open(path + '.tmp', 'w') as file:
+            file.write(self.render())
+        os.replace(path + '.tmp', path)
+
+
+    def start_file(self, path, interval=15):
+        """Write the metrics to ```path``` every ```interval``` seconds from a daemon thread."""
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.write(path)
+                except Exception as e:
+                    print(f"{datetime.now()} - [METRICS] [!] Could not write {path}: {e}")
+        thread = threading.Thread(target=loop, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+
+    def serve(self, port, host='127.0.0.1'):
+        """Expose the metrics on ```http://host:port/metrics``` from a daemon thread."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        print(f"{datetime.now()} - [METRICS] Serving metrics on http://{host}:{port}/metrics")
+        return server
+
+
+@contextmanager
+def span(result, name):
+    """Add the seconds spent in the ```with``` block to ```result['spans'][name]```, the time breakdown of a task."""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        spans = result.setdefault('spans', {})
+        spans[name] = spans.get(name, 0) + time.monotonic() - start
+
+
+async def timed(iterator, result, name):
+    """Iterate over the async ```iterator``` adding the time spent waiting for its items to span ```name``` of ```result```."""
+    iterator = iterator.__aiter__()
+    while True:
+        with span(result, name):
+            try:
+                item = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+        yield item
@@ -0,0 +1,96 @@
+from datetime import datetime
+from store import MessageStore
+from indexes import IndexManager
+from entities import EntityStore
+from bulk import BulkUpdates
+import argparse
+import pymongo
+import re
+
+
+def migrate(db, target, batch_size=1000, drop=False):
+    """Copy every ```messages_{id}``` collection into the collections of the ```target``` store.
+    Progress is saved in the ```migrations``` collection after each batch, so an interrupted migration can be restarted."""
+    indexes = IndexManager(db)
+    sources = sorted(name for name in db.list_collection_names() if re.fullmatch(r'messages_-?\d+', name))
+    print(f"{datetime.now()} - [MIGRATE] Found {len(sources)} collections to migrate")
+    for source in sources:
+        group_id = int(source.split('_')[1])
+        destination = target.collection(group_id)
+        indexes.ensure_messages(destination.name, target.indexes())
+        progress = db['migrations'].find_one({'_id': source}) or {'_id': source, 'last_id': None, 'copied': 0, 'done': False}
+        if progress['done']:
+            continue
+        query = {} if progress['last_id'] is None else {'_id': {'$gt': progress['last_id']}}
+        batch = []
+        for message in db[source].find(query, sort=[('_id', 1)], batch_size=batch_size):
+            batch.append(message)
+            if len(batch) == batch_size:
+                progress = copy_batch(db, target, group_id, destination, batch, progress)
+                batch = []
+        if len(batch) > 0:
+            progress = copy_batch(db, target, group_id, destination, batch, progress)
+        # every message must be found in the destination before the source is dropped
+        copied = destination.count_documents(target.query(group_id))
+        # messages saved twice before the unique index existed are only copied once
+        expected = next(db[source].aggregate([{'$group': {'_id': '$id'}}, {'$count': 'n'}]), {'n': 0})['n']
+        if copied < expected:
+            print(f"{datetime.now()} - [MIGRATE] [!] {source}: {copied} messages out of {expected} found in {destination.name}")
+            continue
+        db['migrations'].update_one({'_id': source}, {'$set': {'done': True}}, upsert=True)
+        db['groups'].update_many({'id': group_id}, {'$set': {'collection_name': destination.name}})
+        print(f"{datetime.now()} - [MIGRATE] {source}: {copied} messages moved to {destination.name}")
+        if drop:
+            db[source].drop()
+
+
+def copy_batch(db, target, group_id, destination, batch, progress):
+    last_id = batch[-1]['_id']
+    documents = [target.document(group_id, message) for message in batch]
+    try:
+        destination.insert_many(documents, ordered=False)
+    except pymongo.errors.BulkWriteError as e:
+        # documents copied by a previous run are rejected as duplicates
+        errors = [error for error in e.details['writeErrors'] if error['code'] != 11000]
+        if len(errors) > 0:
+            raise
+    progress['last_id'] = last_id
+    progress['copied'] += len(batch)
+    db['migrations'].update_one({'_id': progress['_id']}, {'$set': {'last_id': last_id, 'copied': progress['copied']}}, upsert=True)
+    return progress
+
+
+def migrate_entities(db, entities, batch_size=1000):
+    """Move the ```full_entity``` stored inside the ```groups``` documents to the snapshots of ```entities```."""
+    moved = 0
+    updates = BulkUpdates(db['groups'], touch='updated_at')
+    cursor = db['groups'].find({'full_entity': {'$exists': True}}, projection={'_id': 1, 'full_entity': 1, 'entity_hash': 1, 'bots_checked': 1})
+    for group in cursor.batch_size(batch_size):
+        timestamp = group.get('bots_checked') or datetime.now()
+        update = entities.record(group.get('entity_hash'), group['full_entity'], timestamp) or {}
+        update['$unset'] = {'full_entity': ''}
+        updates.update_one({'_id': group['_id']}, update)
+        moved += 1
+        if len(updates) == batch_size:
+            updates.flush()
+    updates.flush()
+    print(f"{datetime.now()} - [MIGRATE] {moved} full channels moved to the {entities.name} collection")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Move the messages_{id} collections into a single (or partitioned) messages collection.")
+    parser.add_argument('--name', default='messages', help="name of the destination collection")
+    parser.add_argument('--partitions', type=int, default=1, help="number of destination collections")
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--drop', action='store_true', help="drop each source collection once it has been copied")
+    parser.add_argument('--entities', action='store_true', help="move the full channels out of the groups documents instead")
+    parser.add_argument('--dbname', default='GroupMonitoring_on_Telegram')
+    args = parser.parse_args()
+
+    # read the connection string from data.txt, as main.py does
+    connection_string = open('data.txt', 'r').readline().rstrip()
+    db = pymongo.MongoClient(connection_string)[args.dbname]
+    if args.entities:
+        migrate_entities(db, EntityStore(db), args.batch_size)
+    else:
+        migrate(db, MessageStore(db, 'single', args.name, args.partitions), args.batch_size, args.drop)
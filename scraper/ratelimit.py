@@ -0,0 +1,121 @@
+from datetime import datetime
+import asyncio
+import json
+import os
+import time
+
+
+# initial rate (requests per second), burst size, minimum and maximum rate of each request class
+DEFAULT_RATES = {
+    'join': {'rate': 1 / 60, 'capacity': 1, 'min_rate': 1 / 3600, 'max_rate': 1 / 20},
+    'history': {'rate': 1, 'capacity': 5, 'min_rate': 1 / 60, 'max_rate': 10},
+    'full_channel': {'rate': 1 / 3, 'capacity': 3, 'min_rate': 1 / 300, 'max_rate': 2},
+    'dialogs': {'rate': 1 / 5, 'capacity': 2, 'min_rate': 1 / 600, 'max_rate': 1},
+}
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity, min_rate, max_rate):
+        self.rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.tokens = capacity
+        self.updated = time.time()
+        # no request can be sent before this time (set by FloodWaitError)
+        self.blocked_until = 0
+        self.successes = 0
+
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+    def delay(self, now):
+        """Seconds to wait before a token is available."""
+        self.refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    def __init__(self, path=None, rates=None, increase=0.1, decrease=0.5, window=20, margin=10):
+        """Token bucket for each request class of an account. After ```window``` requests without errors the rate of a
+        class grows by ```increase```, a FloodWaitError multiplies it by ```decrease``` and caps it so that no more than
+        a burst is sent during the interval Telegram asked to wait. The state is saved as JSON in ```path```."""
+        self.path = path
+        self.increase = increase
+        self.decrease = decrease
+        self.window = window
+        self.margin = margin
+        self.buckets = {}
+        for name, config in DEFAULT_RATES.items():
+            if rates is not None and name in rates:
+                config = {**config, **rates[name]}
+            self.buckets[name] = TokenBucket(**config)
+        self.locks = {}
+        self.load()
+
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as file:
+                state = json.load(file)
+            for name, saved in state.items():
+                if name in self.buckets:
+                    bucket = self.buckets[name]
+                    bucket.rate = min(bucket.max_rate, max(bucket.min_rate, saved['rate']))
+                    bucket.blocked_until = saved['blocked_until']
+        except Exception as e:
+            print(f"{datetime.now()} - [LIMITER] [!] Could not load {self.path}: {e}")
+
+
+    def save(self):
+        if self.path is None:
+            return
+        state = {name: {'rate': bucket.rate, 'blocked_until': bucket.blocked_until} for name, bucket in self.buckets.items()}
+        with open(self.path + '.tmp', 'w') as file:
+            json.dump(state, file)
+        os.replace(self.path + '.tmp', self.path)
+
+
+    async def acquire(self, name):
+        """Wait until a request of class ```name``` can be sent."""
+        bucket = self.buckets[name]
+        # requests of the same class wait in line
+        lock = self.locks.setdefault(name, asyncio.Lock())
+        async with lock:
+            while True:
+                wait = bucket.delay(time.time())
+                if wait <= 0:
+                    bucket.tokens -= 1
+                    return
+                await asyncio.sleep(wait)
+
+
+    def success(self, name):
+        bucket = self.buckets[name]
+        bucket.successes += 1
+        if bucket.successes >= self.window:
+            bucket.successes = 0
+            bucket.rate = min(bucket.max_rate, bucket.rate * (1 + self.increase))
+            self.save()
+
+
+    def flood(self, name, seconds):
+        """Slow down class ```name``` after Telegram asked to wait ```seconds```."""
+        bucket = self.buckets[name]
+        now = time.time()
+        bucket.blocked_until = max(bucket.blocked_until, now + seconds + self.margin)
+        bucket.rate = max(bucket.min_rate, min(bucket.rate * self.decrease, bucket.capacity / max(seconds, 1)))
+        bucket.tokens = 0
+        bucket.updated = now
+        bucket.successes = 0
+        self.save()
+        print(f"{datetime.now()} - [LIMITER] Rate of {name} requests lowered to {bucket.rate * 3600:.1f} per hour")
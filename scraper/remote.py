@@ -0,0 +1,26 @@
+from broker import MongoBroker
+from worker import MonitoringWorker
+from datetime import datetime
+import argparse
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a worker on this host, taking its tasks from the MongoDB broker of the master.")
+    parser.add_argument('worker_id', type=int, help="position of the account in data.txt, starting from 0")
+    parser.add_argument('--starting-date', default='2024-03-01', help="collect messages sent after this date (YYYY-MM-DD)")
+    parser.add_argument('--concurrent-tasks', type=int, default=1)
+    parser.add_argument('--message-store', choices=('per_group', 'single'), default='per_group')
+    parser.add_argument('--dbname', default='GroupMonitoring_on_Telegram')
+    args = parser.parse_args()
+
+    # data.txt has the same format used by main.py: connection string, then api id and hash of each account
+    data = open('data.txt', 'r').readlines()
+    connection_string = data[0].rstrip()
+    api_id = data[1 + 2 * args.worker_id].rstrip()
+    api_hash = data[2 + 2 * args.worker_id].rstrip()
+
+    worker = MonitoringWorker(api_id, api_hash, connection_string, starting_date=datetime.strptime(args.starting_date, '%Y-%m-%d'),
+                              dbname=args.dbname, concurrent_tasks=args.concurrent_tasks, message_store=args.message_store)
+    broker = MongoBroker(connection_string, args.dbname)
+    worker.bind(args.worker_id, broker.tasks(args.worker_id), broker.events())
+    worker.launch_client()
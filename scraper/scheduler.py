@@ -0,0 +1,319 @@
+from collections import deque
+from datetime import datetime, timedelta, timezone
+import heapq
+import itertools
+import json
+import os
+import uuid
+from util import as_utc
+
+
+# fields of the groups kept in memory
+FIELDS = ('username', 'id', 'state', 'worker_id', 'last_update', 'last_message_id', 'entity_hash', 'message_rate', 'number_of_messages')
+# seconds of updates before a snapshot that are read again on restart
+SNAPSHOT_MARGIN = 300
+# checks of update_date used to estimate the rate of groups that have none
+HISTORY = 10
+
+
+class PollingPolicy:
+    def __init__(self, target_messages=500, min_interval=1, max_interval=72, alpha=0.3):
+        """Check a group when about ```target_messages``` new messages are expected, but not more often than every
+        ```min_interval``` hours nor less often than every ```max_interval``` hours. The message rate of a group
+        (messages per hour) is an exponentially weighted moving average, with weight ```alpha```, of the rates seen by its checks."""
+        self.target_messages = target_messages
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.alpha = alpha
+
+
+    def interval(self, rate):
+        if rate is None:
+            return None
+        if rate <= 0:
+            return self.max_interval
+        return min(max(self.target_messages / rate, self.min_interval), self.max_interval)
+
+
+    def observe(self, rate, n_messages, start, end):
+        """Rate after ```n_messages``` new messages were found between ```start``` and ```end```."""
+        if start is None or end is None:
+            return rate
+        # very short spans (e.g. a join that found one message) would give absurd rates
+        hours = max((end - start).total_seconds() / 3600, self.min_interval)
+        observed = n_messages / hours
+        return observed if rate is None else self.alpha * observed + (1 - self.alpha) * rate
+
+
+    def estimate(self, history):
+        """Rate of a group from the entries of its ```update_date```, oldest first."""
+        rate = None
+        for previous, entry in zip(history, history[1:]):
+            rate = self.observe(rate, entry['n_messages'], as_utc(previous['timestamp']), as_utc(entry['timestamp']))
+        return rate
+
+
+class GroupScheduler:
+    def __init__(self, db, n_workers, threshold_check=12, tbp_batch=100, tbp_lease=3600, snapshot_path=None, policy=None):
+        """Keep the state of the groups in memory to pick the next task without querying MongoDB.
+        Groups that can be checked are stored in one heap for each state and worker, keyed by the
+        time they are due; ```tbp``` entries are claimed ```tbp_batch``` at a time and kept for
+        ```tbp_lease``` seconds before another claimer can take them.
+        The state is saved to ```snapshot_path``` by ```save()```: on restart only the groups updated
+        since the snapshot (```updated_at``` field) are read from MongoDB.
+        With a ```policy``` (see ```PollingPolicy```) groups are checked according to their message rate,
+        otherwise every ```threshold_check``` hours."""
+        self.db = db
+        self.n_workers = n_workers
+        self.threshold_check = threshold_check
+        self.tbp_batch = tbp_batch
+        self.tbp_lease = tbp_lease
+        self.snapshot_path = snapshot_path
+        self.policy = policy
+        # username -> group state, id -> username
+        self.groups = {}
+        self.ids = {}
+        # heaps of (due date, version, username), entries whose version is outdated are skipped
+        self.heaps = {
+            'waiting': [[] for _ in range(n_workers)],
+            'inside': [[] for _ in range(n_workers)]
+        }
+        self.versions = itertools.count()
+        self.tbp = deque()
+        self.loaded = False
+        # expected messages per hour of the groups of each worker
+        self.volume = [0.0 for _ in range(n_workers)]
+
+
+    def load(self):
+        saved = self.__load_snapshot()
+        query = {}
+        if saved is not None:
+            # updates made while the snapshot was written, or by a clock slightly behind, are read again
+            query = {'updated_at': {'$gte': saved - timedelta(seconds=SNAPSHOT_MARGIN)}}
+        projection = {field: 1 for field in FIELDS}
+        projection['_id'] = 0
+        if self.policy is not None:
+            projection['update_date'] = {'$slice': -HISTORY}
+        n = 0
+        for group in self.db['groups'].find(query, projection=projection):
+            self.track(group)
+            n += 1
+        self.loaded = True
+        source = 'from MongoDB' if saved is None else f"from the snapshot of {saved}, {n} updated since then"
+        print(f"{datetime.now()} - [SCHEDULER] Loaded {len(self.groups)} groups {source}")
+
+
+    def __load_snapshot(self):
+        # time the snapshot was saved, None if there is no usable snapshot
+        if self.snapshot_path is None or not os.path.exists(self.snapshot_path):
+            return None
+        try:
+            with open(self.snapshot_path, 'r') as file:
+                snapshot = json.load(file)
+        except Exception as e:
+            print(f"{datetime.now()} - [SCHEDULER] [!] Could not load {self.snapshot_path}: {e}")
+            return None
+        for group in snapshot['groups']:
+            group = dict(zip(FIELDS, group))
+            if group['last_update'] is not None:
+                group['last_update'] = datetime.fromisoformat(group['last_update'])
+            self.track(group)
+        return datetime.fromisoformat(snapshot['saved'])
+
+
+    def save(self):
+        """Write the state of the groups to ```snapshot_path```."""
+        if self.snapshot_path is None or not self.loaded:
+            return
+        saved = datetime.now(tz=timezone.utc)
+        groups = []
+        for group in self.groups.values():
+            values = [group.get(field) for field in FIELDS]
+            if values[FIELDS.index('last_update')] is not None:
+                values[FIELDS.index('last_update')] = values[FIELDS.index('last_update')].isoformat()
+            groups.append(values)
+        with open(self.snapshot_path + '.tmp', 'w') as file:
+            json.dump({'saved': saved.isoformat(), 'groups': groups}, file)
+        os.replace(self.snapshot_path + '.tmp', self.snapshot_path)
+
+
+    def next_due(self, group):
+        interval = None
+        if self.policy is not None and group['state'] == 'inside':
+            interval = self.policy.interval(group['message_rate'])
+        if interval is None:
+            interval = self.threshold_check
+        return group['last_update'] + timedelta(hours=interval)
+
+
+    def observe(self, group, n_messages, start, end):
+        """Update the message rate of ```group``` after ```n_messages``` were found between ```start``` and ```end```,
+        return the new rate (None without a policy)."""
+        if self.policy is None or group is None:
+            return None
+        self.__count(group, -1)
+        group['message_rate'] = self.policy.observe(group['message_rate'], n_messages, as_utc(start), as_utc(end))
+        self.__count(group, 1)
+        return group['message_rate']
+
+
+    @staticmethod
+    def rate(group):
+        """Expected messages per hour of ```group```: its measured rate, or the one of the last week on TGStat."""
+        if group.get('message_rate') is not None:
+            return group['message_rate']
+        return (group.get('number_of_messages') or 0) / (7 * 24)
+
+
+    def __count(self, group, sign):
+        # add (sign 1) or remove (sign -1) the group from the volume of its worker
+        worker_id = group.get('worker_id')
+        if group['state'] != 'failed' and worker_id is not None and 0 <= worker_id < self.n_workers:
+            self.volume[worker_id] += sign * self.rate(group)
+
+
+    def __push(self, group):
+        group['version'] = next(self.versions)
+        worker_id = group.get('worker_id')
+        if group['state'] in self.heaps and worker_id is not None and 0 <= worker_id < self.n_workers:
+            heapq.heappush(self.heaps[group['state']][worker_id], (self.next_due(group), group['version'], group['username']))
+
+
+    def track(self, group):
+        """Add ```group``` (a document of the ```groups``` collection) to the scheduler."""
+        group['last_update'] = as_utc(group.get('last_update'))
+        group.setdefault('id', None)
+        group.setdefault('worker_id', None)
+        group.setdefault('last_message_id', None)
+        group.setdefault('entity_hash', None)
+        group.setdefault('message_rate', None)
+        history = group.pop('update_date', None)
+        if self.policy is not None and group['message_rate'] is None and history:
+            group['message_rate'] = self.policy.estimate(history)
+        if group['username'] in self.groups:
+            self.__count(self.groups[group['username']], -1)
+        self.groups[group['username']] = group
+        self.__count(group, 1)
+        if group['id'] not in (None, ""):
+            # a group renamed after the snapshot is found again under its new username
+            old_username = self.ids.get(group['id'])
+            if old_username is not None and old_username != group['username'] and old_username in self.groups:
+                self.__count(self.groups.pop(old_username), -1)
+            self.ids[group['id']] = group['username']
+        self.__push(group)
+
+
+    def get(self, username=None, id=None):
+        if username is None:
+            username = self.ids.get(id)
+        return self.groups.get(username)
+
+
+    def update(self, username=None, id=None, new_username=None, **fields):
+        """Update the state of a group after a task has been dispatched or a result has been received.
+        The group is looked up by ```username``` if given, and ```id``` is then stored as its id;
+        ```new_username``` renames the group."""
+        group = self.get(username, id)
+        if group is None:
+            return None
+        if id is not None:
+            fields['id'] = id
+        if new_username is not None:
+            fields['username'] = new_username
+        if 'username' in fields and fields['username'] != group['username']:
+            self.groups.pop(group['username'], None)
+            self.groups[fields['username']] = group
+        if 'last_update' in fields:
+            fields['last_update'] = as_utc(fields['last_update'])
+        self.__count(group, -1)
+        group.update(fields)
+        self.__count(group, 1)
+        if group['id'] not in (None, ""):
+            self.ids[group['id']] = group['username']
+        self.__push(group)
+        return group
+
+
+    def forget(self, username):
+        group = self.groups.pop(username, None)
+        if group is None:
+            return
+        self.__count(group, -1)
+        if self.ids.get(group['id']) == username:
+            del self.ids[group['id']]
+
+
+    def movable(self, worker_id):
+        """Groups of ```worker_id``` that can be moved to another worker, the busiest first."""
+        groups = [group for group in self.groups.values()
+                  if group['worker_id'] == worker_id and group['state'] == 'inside' and group.get('moving') is None]
+        return sorted(groups, key=self.rate, reverse=True)
+
+
+    def next_time(self, state, worker_id):
+        """Time the next group of ```worker_id``` in ```state``` is due, None if it has no such group."""
+        heap = self.heaps[state][worker_id]
+        while len(heap) > 0:
+            due, version, username = heap[0]
+            group = self.groups.get(username)
+            if group is None or group['version'] != version or group['state'] != state:
+                heapq.heappop(heap)
+                continue
+            return due
+        return None
+
+
+    def pop_due(self, state, worker_id, now=None):
+        """Return the group of ```worker_id``` in ```state``` that has been due for the longest time, if any."""
+        if now is None:
+            now = datetime.now(tz=timezone.utc)
+        due = self.next_time(state, worker_id)
+        if due is None or due > now:
+            return None
+        _, _, username = heapq.heappop(self.heaps[state][worker_id])
+        return self.groups[username]
+
+
+    def __claim_tbp(self):
+        """Claim a batch of ```tbp``` entries, return False if there are none left."""
+        now = datetime.now(tz=timezone.utc)
+        claimable = {'$or': [{'claimed_until': {'$exists': False}}, {'claimed_until': {'$lt': now}}]}
+        ids = [entry['_id'] for entry in self.db['tbp'].find(claimable, projection={'_id': 1}).limit(self.tbp_batch)]
+        if len(ids) == 0:
+            return False
+        token = uuid.uuid4().hex
+        # entries taken by someone else in the meantime no longer match the filter
+        self.db['tbp'].update_many(
+            {'$and': [{'_id': {'$in': ids}}, claimable]},
+            {'$set': {'claimed': token, 'claimed_until': now + timedelta(seconds=self.tbp_lease)}}
+        )
+        seen = set()
+        for entry in self.db['tbp'].find({'claimed': token}):
+            if entry['username'] not in self.groups and entry['username'] not in seen:
+                self.tbp.append(entry)
+            seen.add(entry['username'])
+        # drop the entries of groups that are already known
+        known = [username for username in seen if username in self.groups]
+        if len(known) > 0:
+            self.db['tbp'].delete_many({'username': {'$in': known}})
+        return True
+
+
+    def peek_tbp(self):
+        """Return the next group to be joined without removing it, None if ```tbp``` is empty."""
+        while len(self.tbp) > 0 or self.__claim_tbp():
+            if len(self.tbp) > 0 and self.tbp[0]['username'] not in self.groups:
+                return self.tbp[0]
+            if len(self.tbp) > 0:
+                self.tbp.popleft()
+        return None
+
+
+    def pop_tbp(self):
+        entry = self.peek_tbp()
+        if entry is not None:
+            self.tbp.popleft()
+            for field in ('_id', 'claimed', 'claimed_until'):
+                entry.pop(field, None)
+        return entry
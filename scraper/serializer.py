@@ -0,0 +1,99 @@
+import zlib
+import bson
+
+
+# fields of a message kept by CompactSerializer
+MESSAGE_FIELDS = ('id', 'date', 'message', 'from_id', 'reply_to', 'fwd_from', 'via_bot_id', 'media', 'entities', 'action',
+                  'views', 'forwards', 'replies', 'reactions', 'edit_date', 'post_author', 'grouped_id', 'pinned')
+# fields of a full channel kept by CompactSerializer
+ENTITY_FIELDS = ('full_chat', 'chats', 'users')
+# objects whose type tag is kept (renamed to ```type```) since it tells what they contain
+TYPED_FIELDS = ('media', 'action', 'entities')
+PEER_TYPES = {'PeerUser': ('user', 'user_id'), 'PeerChannel': ('channel', 'channel_id'), 'PeerChat': ('chat', 'chat_id')}
+
+
+class Serializer:
+    """Turn messages and entities into documents as they are returned by Telethon ```to_dict()```."""
+    def message(self, message):
+        return message.to_dict()
+
+
+    def entity(self, entity):
+        return entity.to_dict()
+
+
+class CompactSerializer(Serializer):
+    def __init__(self, message_fields=MESSAGE_FIELDS, entity_fields=ENTITY_FIELDS, flatten=True, keep_raw=False):
+        """Keep only ```message_fields``` and ```entity_fields``` (all fields if None), drop null values, type tags and raw bytes.
+        With ```flatten``` peers become ids, reply headers, replies and reactions become plain values.
+        With ```keep_raw``` the full ```to_dict()``` of a message is also stored, BSON encoded and compressed, in ```raw```."""
+        self.message_fields = None if message_fields is None else set(message_fields) | {'id', 'date'}
+        self.entity_fields = None if entity_fields is None else set(entity_fields)
+        self.flatten = flatten
+        self.keep_raw = keep_raw
+
+
+    def compact(self, value, typed=False):
+        if isinstance(value, dict):
+            result = {}
+            for key, item in value.items():
+                if key == '_':
+                    if typed:
+                        result['type'] = item
+                    continue
+                item = self.compact(item)
+                if item is not None:
+                    result[key] = item
+            return result
+        if isinstance(value, list):
+            return [self.compact(item, typed) for item in value]
+        if isinstance(value, bytes):
+            return None
+        return value
+
+
+    def __flatten(self, doc):
+        for field in ('from_id', 'peer_id'):
+            peer = doc.get(field)
+            if isinstance(peer, dict) and peer.get('_') in PEER_TYPES:
+                kind, key = PEER_TYPES[peer['_']]
+                doc[field] = peer[key]
+                if kind != 'user':
+                    doc[field.replace('_id', '_type')] = kind
+        fwd_from = doc.get('fwd_from')
+        if isinstance(fwd_from, dict):
+            self.__flatten(fwd_from)
+        reply_to = doc.get('reply_to')
+        if isinstance(reply_to, dict):
+            doc['reply_to'] = reply_to.get('reply_to_msg_id')
+            if reply_to.get('reply_to_top_id') is not None:
+                doc['reply_to_top_id'] = reply_to['reply_to_top_id']
+        replies = doc.get('replies')
+        if isinstance(replies, dict):
+            doc['replies'] = replies.get('replies')
+        reactions = doc.get('reactions')
+        if isinstance(reactions, dict):
+            doc['reactions'] = [
+                {'reaction': item['reaction'].get('emoticon', item['reaction'].get('document_id')), 'count': item['count']}
+                for item in reactions.get('results', []) if isinstance(item.get('reaction'), dict)
+            ]
+
+
+    def message(self, message):
+        raw = message.to_dict()
+        # encoded before flattening, which changes the nested dicts shared with raw
+        payload = zlib.compress(bson.encode(raw)) if self.keep_raw else None
+        doc = {key: value for key, value in raw.items() if self.message_fields is None or key in self.message_fields}
+        if self.flatten:
+            self.__flatten(doc)
+        doc = {key: self.compact(value, key in TYPED_FIELDS) for key, value in doc.items()}
+        doc = {key: value for key, value in doc.items() if value is not None}
+        if payload is not None:
+            doc['raw'] = payload
+        return doc
+
+
+    def entity(self, entity):
+        raw = entity.to_dict()
+        doc = {key: value for key, value in raw.items() if self.entity_fields is None or key in self.entity_fields}
+        return self.compact(doc)
@@ -0,0 +1,65 @@
+LAYOUTS = ('per_group', 'single')
+
+
+class MessageStore:
+    def __init__(self, db, layout='per_group', name='messages', partitions=1):
+        """Decide where the messages of a group are stored:
+        - ```per_group``` (default) one ```messages_{id}``` collection for each group, documents are stored as they are;
+        - ```single``` all groups in ```name``` (or in ```partitions``` collections ```{name}_p{n}```), each document
+        carries a ```group_id``` field and is unique on ```(group_id, id)```."""
+        if layout not in LAYOUTS:
+            raise ValueError(f"Unknown message store layout '{layout}', expected one of {LAYOUTS}")
+        self.db = db
+        self.layout = layout
+        self.name = name
+        self.partitions = partitions
+
+
+    def collection_name(self, group_id):
+        if self.layout == 'per_group':
+            return f"messages_{group_id}"
+        if self.partitions == 1:
+            return self.name
+        return f"{self.name}_p{abs(group_id) % self.partitions}"
+
+
+    def collection(self, group_id):
+        return self.db[self.collection_name(group_id)]
+
+
+    def collection_names(self):
+        """Names of the collections holding messages with this layout."""
+        if self.layout == 'per_group':
+            return [name for name in self.db.list_collection_names() if name.startswith('messages_')]
+        if self.partitions == 1:
+            return [self.name]
+        return [f"{self.name}_p{n}" for n in range(self.partitions)]
+
+
+    def indexes(self):
+        if self.layout == 'per_group':
+            return [([('id', 1)], {'unique': True})]
+        return [
+            ([('group_id', 1), ('id', 1)], {'unique': True}),
+            ([('group_id', 1), ('date', 1)], {}),
+            # messages of a group in insertion order, read by the exporter
+            ([('group_id', 1), ('_id', 1)], {}),
+        ]
+
+
+    def query(self, group_id, filter=None):
+        """Filter selecting the messages of ```group_id``` (combined with ```filter```)."""
+        filter = {} if filter is None else dict(filter)
+        if self.layout == 'single':
+            filter['group_id'] = group_id
+        return filter
+
+
+    def document(self, group_id, message):
+        """Turn the dictionary of a message into the document to be stored."""
+        if self.layout == 'per_group':
+            return message
+        # the peer is the group itself in this layout
+        message.pop('peer_id', None)
+        message['group_id'] = group_id
+        return message
@@ -1,18 +1,42 @@
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
-from time import sleep
+from time import sleep, monotonic
+import threading
 import pymongo
 import re
+from indexes import IndexManager
+from httpcache import HTTPCache
+from metrics import Metrics
+
+
+TITLE = re.compile(rb'<title[^>]*>(.*?)</title>', re.S | re.I)
 
 
 class TGStatScraper:
-    def __init__(self, url, connection_string, max_requests=3, language_threshold=5, language="English", limit=100, connect=True, translation_set=None, dbname='GroupMonitoring_on_Telegram'):
+    def __init__(self, url, connection_string, max_requests=3, language_threshold=5, language="English", limit=100, connect=True, translation_set=None, dbname='GroupMonitoring_on_Telegram', max_workers=8, backoff=5, cache_path='tgstat_cache', cache_size=200 * 2**20, cache_ttls=None, metrics=None, session=None):
         self.url = url
         self.headers = {
             'User-Agent': 'Mozilla/5.0',
             'Accept-Language': 'en-US,en;q=0.5'
         }
+        # keep connections to tgstat.com open, at most max_workers pages are downloaded at the same time
+        self.max_workers = max_workers
+        if session is None:
+            session = requests.Session()
+            session.headers.update(self.headers)
+            session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=max_workers))
+        self.session = session
+        # a 429 error stops every thread for backoff seconds
+        self.backoff = backoff
+        self.backoff_until = 0
+        self.backoff_lock = threading.Lock()
+        # pages are kept on disk and revalidated when their TTL expires (no cache if cache_path is None)
+        self.cache = None if cache_path is None else HTTPCache(cache_path, cache_size, cache_ttls)
+        # pass the metrics of the master to expose them together
+        self.metrics = Metrics() if metrics is None else metrics
         self.topic = {}
         self.groups = {}
         self.max_requests = max_requests
@@ -28,6 +52,9 @@ class TGStatScraper:
         except Exception as e:
             print(f"{datetime.now()} - [!] Error in opening database connection: {e}")
             exit(-1)
+        self.indexes = IndexManager(self.db)
+        self.indexes.ensure(['seed', 'topics', 'tbp'])
+        self.indexes.verify(['seed', 'topics', 'tbp'])
         # Request topics
         if connect:
             self.response = self.request(url)
@@ -55,20 +82,70 @@ class TGStatScraper:
                 self.db['topics'].insert_one(topic)
 
 
+    def __wait_backoff(self):
+        with self.backoff_lock:
+            wait = self.backoff_until - monotonic()
+        if wait > 0:
+            sleep(wait)
+
+
     def request(self, url):
+        if self.cache is not None:
+            page = self.cache.get(url)
+            if page is not None:
+                self.metrics.inc('http_requests_total', 1, "Pages requested to TGStat", cache='hit', status=200)
+                return page
         repeat = True
         counter = 0
         while repeat and counter < self.max_requests:
-            response = requests.get(url, headers=self.headers)
-            soup = BeautifulSoup(response.content, 'html.parser')
-            title = soup.find('title')
-            if "429" not in title.contents[0]:
+            self.__wait_backoff()
+            headers = {} if self.cache is None else self.cache.headers(url)
+            with self.metrics.time('http_seconds', "Duration of the requests to TGStat"):
+                response = self.session.get(url, headers=headers)
+            if response.status_code == 304:
+                page = self.cache.revalidated(url)
+                if page is not None:
+                    self.metrics.inc('http_requests_total', 1, cache='revalidated', status=304)
+                    return page
+                # the page was evicted meanwhile
+                response = self.session.get(url)
+            title = TITLE.search(response.content)
+            if title is None or b"429" not in title.group(1):
                 repeat = False
+                self.metrics.inc('http_requests_total', 1, cache='miss', status=response.status_code)
             else:
                 print(f"{datetime.now()} - [TGStat] Encountered 429 Error")
-                sleep(5)
+                self.metrics.inc('http_requests_total', 1, cache='miss', status=429)
+                with self.backoff_lock:
+                    self.backoff_until = max(self.backoff_until, monotonic() + self.backoff)
                 counter += 1
-        return None if repeat else response
+        if repeat:
+            return None
+        if self.cache is not None and response.status_code == 200:
+            return self.cache.store(url, response)
+        return response
+
+
+    def parse(self, response, name, function):
+        """Result of ```function(response)```, reused from the cache if the same page was already parsed."""
+        def timed(response):
+            with self.metrics.time('parse_seconds', "Duration of the parsing of TGStat pages", page=name):
+                return function(response)
+        if self.cache is None or not hasattr(response, 'hash'):
+            return timed(response)
+        return self.cache.memo(response, name, timed)
+
+
+    def fetch_many(self, urls):
+        """Download ```urls``` concurrently, return the responses in the same order (None for the failed ones)."""
+        def fetch(url):
+            try:
+                return self.request(url)
+            except Exception as e:
+                print(url, e)
+                return None
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(fetch, urls))
 
 
     def __get_group_ranking(self, url, topic, public=True, sort='members'):
@@ -84,78 +161,101 @@ class TGStatScraper:
         date_gathered = datetime.now(tz=timezone.utc)
         self.db['topics'].update_one({'name': topic}, {'$push': {'groups_gathered_dates': date_gathered}})
         # Check if the request was successful (status code 200)
-        if response.status_code == 200:
-            # Parse the HTML content
-            soup = BeautifulSoup(response.content, 'html.parser')
-
-            # Find all the chat elements
-            chat_elements = soup.find_all('div', {'class': "card peer-item-row mb-2 ribbon-box border"})
-
-            groups=[]
-            for chat in chat_elements:
-                chat_name = chat.find('div', class_="text-truncate font-16 text-dark mt-n1").text.strip()
-                topic=chat.find('div', class_="text-truncate font-12 text-dark").text.strip()
-                number_partecipants = chat.find('div', class_="text-truncate font-14 text-dark mt-n1").text.strip()
-                number_messages=chat.find('div', {'class':"text-center",'data-html':"true", 'data-original-title':"Number of messages in the group in the last 7 days", 'data-placement':"top", 'data-toggle':"tooltip", 'data-trigger':"click", 'title':""}).text.strip().split('\n')[0].strip()
-                number_active_users=chat.find('h4', {'class':"text-dark font-weight-normal mb-1 font-16 font-sm-18"}).text.strip()#, 'data-html':"true",'data-placement':"top", 'data-toggle':"tooltip", 'data-trigger':"click", 'title':""})
-
-
-                # Find the <div> tag with the specified class
-                div_tag = chat.find('div', class_='col col-12 col-sm-5 col-md-5 col-lg-4')
-                # Find the <a> tag inside the <div>
-                link_tag = div_tag.find('a')
-                # Get the value of the 'href' attribute
-                link = link_tag.get('href')
-                # Define a regular expression pattern to match the username
-                pattern = r'/@([a-zA-Z0-9_]+)'
-                # Search for the username in the URL path using the regular expression
-                username = re.search(pattern, link).group(1)
-
-                group = {
-                    "chat_name": chat_name,
-                    "username": username,
-                    "topic": topic,
-                    "number_of_messages": int(float(number_messages.strip('k'))*1000) if 'k'in number_messages else ( int(float(number_messages.strip('m'))*1000000) if  'm' in number_messages else int(number_messages)),
-                    "number_active_users": int(''.join(re.findall(r'\d+', number_active_users))),
-                    "tg_link": link,
-                    "country": "",
-                    "language": "",
-                    "date_gathered": date_gathered
-                }
-                groups.append(group)
-                if self.db['seed'].find_one({'tg_link': link}) is None:
-                    self.db['seed'].insert_one(group)
+        if response is not None and response.status_code == 200:
+            # copies, the parsed groups are kept by the cache
+            groups = [dict(group, date_gathered=date_gathered) for group in self.parse(response, 'ranking', self.__parse_ranking)]
+            # insert the groups that are not in seed yet with a single query and a single write
+            links = [group['tg_link'] for group in groups]
+            known = {entry['tg_link'] for entry in self.db['seed'].find({'tg_link': {'$in': links}}, projection={'_id': 0, 'tg_link': 1})}
+            new_groups = []
+            for group in groups:
+                if group['tg_link'] not in known:
+                    known.add(group['tg_link'])
+                    new_groups.append(group)
+            if len(new_groups) > 0:
+                self.db['seed'].insert_many(new_groups)
             return groups
         else:
             print(url,"Failed to retrieve page.")
             return  None
 
+
+    def __parse_ranking(self, response):
+        # Parse the HTML content
+        soup = BeautifulSoup(response.content, 'html.parser')
+
+        # Find all the chat elements
+        chat_elements = soup.find_all('div', {'class': "card peer-item-row mb-2 ribbon-box border"})
+
+        groups=[]
+        for chat in chat_elements:
+            chat_name = chat.find('div', class_="text-truncate font-16 text-dark mt-n1").text.strip()
+            topic=chat.find('div', class_="text-truncate font-12 text-dark").text.strip()
+            number_partecipants = chat.find('div', class_="text-truncate font-14 text-dark mt-n1").text.strip()
+            number_messages=chat.find('div', {'class':"text-center",'data-html':"true", 'data-original-title':"Number of messages in the group in the last 7 days", 'data-placement':"top", 'data-toggle':"tooltip", 'data-trigger':"click", 'title':""}).text.strip().split('\n')[0].strip()
+            number_active_users=chat.find('h4', {'class':"text-dark font-weight-normal mb-1 font-16 font-sm-18"}).text.strip()#, 'data-html':"true",'data-placement':"top", 'data-toggle':"tooltip", 'data-trigger':"click", 'title':""})
+
+
+            # Find the <div> tag with the specified class
+            div_tag = chat.find('div', class_='col col-12 col-sm-5 col-md-5 col-lg-4')
+            # Find the <a> tag inside the <div>
+            link_tag = div_tag.find('a')
+            # Get the value of the 'href' attribute
+            link = link_tag.get('href')
+            # Define a regular expression pattern to match the username
+            pattern = r'/@([a-zA-Z0-9_]+)'
+            # Search for the username in the URL path using the regular expression
+            username = re.search(pattern, link).group(1)
+
+            group = {
+                "chat_name": chat_name,
+                "username": username,
+                "topic": topic,
+                "number_of_messages": int(float(number_messages.strip('k'))*1000) if 'k'in number_messages else ( int(float(number_messages.strip('m'))*1000000) if  'm' in number_messages else int(number_messages)),
+                "number_active_users": int(''.join(re.findall(r'\d+', number_active_users))),
+                "tg_link": link,
+                "country": "",
+                "language": "",
+            }
+            groups.append(group)
+        return groups
+
         
     def get_group_ranking(self, topic, public=True, sort='members'):
         print(f"{datetime.now()} - [TGStat] Getting ranking for topic '{topic}'")
         groups = self.__get_group_ranking('https://tgstat.com/'+self.topic[topic], topic, public=public, sort=sort)
         limit = self.limit if self.limit < len(groups) else len(groups)
         self.groups[topic] = groups
+
+
+    def get_group_rankings(self, topics, public=True, sort='members'):
+        """Get the rankings of several topics concurrently."""
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.get_group_ranking, topic, public=public, sort=sort): topic for topic in topics}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    # the other topics are still ranked
+                    print(f"{datetime.now()} - [TGStat] [!] Could not get the ranking for topic '{futures[future]}': {e}")
     
 
     def enrich_topic_with_language(self, topic):
         print(f"{datetime.now()} - [TGStat] Getting language and country for topic '{topic}'")
         country_dict = {}
         language_dict = {}
-        for i, group in enumerate(self.groups[topic]):
-            url = group['tg_link']
-            check = self.db['seed'].find_one({'tg_link': url, 'country': {'$ne': ""}, 'language': {'$ne': ""}})
-            if check is not None:
-                continue
+        # groups whose country and language are already known are skipped
+        links = [group['tg_link'] for group in self.groups[topic]]
+        known = {entry['tg_link'] for entry in self.db['seed'].find({'tg_link': {'$in': links}, 'country': {'$ne': ""}, 'language': {'$ne': ""}}, projection={'_id': 0, 'tg_link': 1})}
+        indexes = [i for i, group in enumerate(self.groups[topic]) if group['tg_link'] not in known]
+        # download the pages of the groups concurrently
+        responses = self.fetch_many([self.groups[topic][i]['tg_link'] for i in indexes])
+        for i, response in zip(indexes, responses):
+            url = self.groups[topic][i]['tg_link']
             try:
-                response = self.request(url)
                 # Check if the request was successful (status code 200)
-                if response.status_code == 200:
-                    # Parse the HTML content of the page
-                    soup = BeautifulSoup(response.content, 'html.parser')
-                    country, language = soup.find('div', {'class': "mt-4"}).text.split('\n')[-2:]
-                    country = country[:-1].strip().replace(' ', '_')
-                    language = language.strip().replace(' ', '_')
+                if response is not None and response.status_code == 200:
+                    country, language = self.parse(response, 'language', self.__parse_language)
                     if language in self.translation_set:
                         language = self.language
 
@@ -189,16 +289,32 @@ class TGStatScraper:
             self.db['topics'].update_one({'name': topic}, {command: {f'languages.{language}': language_dict[language]}})
 
 
+    def __parse_language(self, response):
+        # Parse the HTML content of the page
+        soup = BeautifulSoup(response.content, 'html.parser')
+        country, language = soup.find('div', {'class': "mt-4"}).text.split('\n')[-2:]
+        country = country[:-1].strip().replace(' ', '_')
+        language = language.strip().replace(' ', '_')
+        return [country, language]
+
+
     def send_to_processing(self, topic):
         print(f"{datetime.now()} - [TGStat] Groups were found for topic '{topic}', sent to processing")
-        cursor = self.db['seed'].find({'topic': topic})
-        for entry in cursor:
-            entry['last_update'] = datetime.now(tz=timezone.utc)
-            entry['messages'] = []
-            entry.pop('_id', None)
-            check_groups = self.db['groups'].find_one({'username': entry['username']})
-            if check_groups is None:
+        entries = list(self.db['seed'].find({'topic': topic}, projection={'_id': 0}))
+        usernames = [entry['username'] for entry in entries]
+        # groups already joined or already waiting in tbp are skipped
+        in_groups = {group['username'] for group in self.db['groups'].find({'username': {'$in': usernames}}, projection={'_id': 0, 'username': 1})}
+        in_tbp = {entry['username'] for entry in self.db['tbp'].find({'username': {'$in': usernames}}, projection={'_id': 0, 'username': 1})}
+        now = datetime.now(tz=timezone.utc)
+        new_entries = []
+        for entry in entries:
+            if entry['username'] in in_groups:
+                print(f"{datetime.now()} - [TGStat] Group {entry['username']} was not inserted in tpb since it already is in groups")
+            elif entry['username'] not in in_tbp:
                 print(f"{datetime.now()} - [TGStat] Group {entry['username']} sent to processing")
-                self.db['tbp'].insert_one(entry)
-            else:
-                print(f"{datetime.now()} - [TGStat] Group {entry['username']} was not inserted in tpb since it already is in groups")
\ No newline at end of file
+                entry['last_update'] = now
+                entry['messages'] = []
+                in_tbp.add(entry['username'])
+                new_entries.append(entry)
+        if len(new_entries) > 0:
+            self.db['tbp'].insert_many(new_entries)
@@ -1,6 +1,16 @@
+from datetime import timezone
+
+
 def wait_time(e):
     wait_l = [int(word) for word in str(e).split() if word.isdigit()]
     wait = ''
     for digit in wait_l:
         wait += str(digit)
-    return int(wait)
\ No newline at end of file
+    return int(wait)
+
+
+def as_utc(date):
+    # pymongo returns naive datetimes expressed in UTC
+    if date is not None and date.tzinfo is None:
+        return date.replace(tzinfo=timezone.utc)
+    return date
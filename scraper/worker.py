@@ -1,38 +1,65 @@
 import asyncio
 from datetime import datetime, timedelta, timezone
-import random
+import time
 import pymongo
 import telethon
 from telethon.tl.functions.channels import JoinChannelRequest
 from telethon.tl.functions.channels import GetFullChannelRequest
+from telethon.tl.functions.channels import GetChannelsRequest
+from telethon.tl.functions.channels import LeaveChannelRequest
+from telethon.tl.types import PeerChannel, Channel, InputChannel, InputPeerChannel
+from dialogs import DialogIndex
+from indexes import IndexManager
+from live import LiveStream
+from metrics import Metrics, span, timed
+from ratelimit import RateLimiter
+from store import MessageStore
+from serializer import Serializer
 from util import *
+from writer import MessageWriter, WritePipeline
+
+
+# result codes of the tasks that do not fail their group when they fail
+FAILURE_CODES = {'MOVE_JOIN': "MOVE_FAILED", 'LEAVE': "LEAVE_FAILED"}
 
 
 class MonitoringWorker:
-    def __init__(self, api_id, api_hash, connection_string, messages_limit=None, messages_limit_days=30, starting_date=None, dbname='GroupMonitoring_on_Telegram'):
+    def __init__(self, api_id, api_hash, connection_string, messages_limit=None, messages_limit_days=30, starting_date=None, dbname='GroupMonitoring_on_Telegram', write_batch_size=500, write_flush_interval=5, write_queue_size=10000, concurrent_tasks=1, rates=None, message_store='per_group', serializer=None, metrics_interval=15, live=False):
         self.api_id = api_id
         self.api_hash = api_hash
         # set limits for message scraping
         self.messages_limit = messages_limit
         self.messages_limit_days = messages_limit_days
         self.starting_date = starting_date
-        # set lower bound and upper bound of the wait interval before joining a channel
-        self.join_wait_lb = 55
-        self.join_wait_ub = 65
-        # set lower bound and upper bound of the wait interval before leaving a channel
-        self.leave_wait_lb = 0
-        self.leave_wait_ub = 5
+        # initial rates of join, history, full_channel and dialogs requests (see ratelimit.DEFAULT_RATES)
+        self.rates = rates
+        # set size and time limit of the buffer used to write messages
+        self.write_batch_size = write_batch_size
+        self.write_flush_interval = write_flush_interval
+        # maximum number of fetched messages waiting to be written
+        self.write_queue_size = write_queue_size
+        # maximum number of tasks in flight, joins are still paced by the join bucket of the rate limiter
+        self.concurrent_tasks = concurrent_tasks
+        # layout of the collections holding messages (see store.MessageStore)
+        self.message_store = message_store
+        # how messages and entities are turned into documents, to_dict() is stored verbatim by default
+        self.serializer = Serializer() if serializer is None else serializer
+        # metrics are written to session_<id>.metrics.prom every metrics_interval seconds
+        self.metrics_interval = metrics_interval
+        # with live, new messages are received from the update stream and checks only fetch the gaps (see live.LiveStream)
+        self.live_mode = live
+        self.live = None
         # MongoDB connection string
         self.connection_string = connection_string
         self.dbname = dbname
 
 
-    def bind(self, pid, tasks, result_queue, process_queue):
+    def bind(self, pid, tasks, events):
         # set id and bind queues to the slave
         self.pid = pid
         self.task_queue = tasks
-        self.result_queue = result_queue
-        self.process_queue = process_queue
+        # results and free slots are sent to the master on the same queue, as ('RESULT', result) and ('FREE', pid)
+        self.events = events
         # initialize TelegramClient object with the given API id and hash
         self.client = telethon.TelegramClient(
             f"session_{str(self.pid)}", self.api_id, self.api_hash)
@@ -40,6 +67,10 @@ class MonitoringWorker:
 
     def launch_client(self):
         self.db = pymongo.MongoClient(self.connection_string)[self.dbname]
+        self.indexes = IndexManager(self.db)
+        self.store = MessageStore(self.db, self.message_store)
+        self.metrics = Metrics()
+        self.metrics.start_file(f"session_{str(self.pid)}.metrics.prom", self.metrics_interval)
         with self.client:
             self.client.loop.run_until_complete(self.__work())
             self.client.disconnect()
@@ -48,9 +79,46 @@ class MonitoringWorker:
     async def __work(self):
         me = await self.client.get_me()
         print(f"{datetime.now()} - [WORKER n.{self.pid}]: Worker {me.username} launched")
-        await self.__crawl_worker()
+        # requests are paced by a limiter that adapts to flood waits, its state survives restarts
+        self.limiter = RateLimiter(f"session_{str(self.pid)}.ratelimit.json", self.rates)
+        # index of the groups the account is in, stored next to the session file
+        self.dialogs = DialogIndex(self.client, f"session_{str(self.pid)}.dialogs.json", self.limiter)
+        self.dialogs.load()
+        if not self.dialogs.built:
+            await self.dialogs.build()
+        # messages are written by the pipeline while the client keeps fetching
+        self.pipeline = WritePipeline(self.write_queue_size, self.write_flush_interval, self.metrics)
+        self.pipeline.start()
+        self.metrics.collect(self.__collect_metrics)
+        if self.live_mode:
+            self.live = LiveStream(self)
+            self.live.start()
+        try:
+            await self.__crawl_worker()
+        finally:
+            await self.pipeline.stop()
     
 
+    def __collect_metrics(self, metrics):
+        metrics.set('write_queue_size', self.pipeline.queue.qsize(), "Messages waiting to be written")
+        metrics.set('write_pending_writers', len(self.pipeline.pending), "Collections with buffered messages")
+        for name, bucket in self.limiter.buckets.items():
+            metrics.set('limiter_rate', bucket.rate, "Requests per second allowed by the rate limiter", request=name)
+            metrics.set('limiter_blocked_seconds', max(0, bucket.blocked_until - time.time()), "Seconds left of the current flood wait", request=name)
+
+
+    async def acquire(self, request, result):
+        # the time spent waiting for a token is part of the time breakdown of the task
+        with span(result, 'limiter'):
+            await self.limiter.acquire(request)
+
+
+    def flood(self, request, wait, result):
+        result['flood_wait'] = result.get('flood_wait', 0) + wait
+        self.metrics.inc('flood_wait_seconds_total', wait, "Seconds Telegram asked to wait", request=request)
+        self.limiter.flood(request, wait)
+
+
     def get_offset_date(self):
         if self.starting_date is None:
             offset_date = datetime.now(tz=timezone.utc) - timedelta(self.messages_limit_days)
@@ -62,25 +130,34 @@ class MonitoringWorker:
     async def join_public_group(self, username, result):
         """Join the group with the given ```username```."""
         print(f"{datetime.now()} - [WORKER n.{self.pid}] Joining public group '{result['username']}'")
+        request = 'full_channel'
         try:
             # join the group with the given username
-            full_entity = await self.client(GetFullChannelRequest(username))
+            await self.acquire(request, result)
+            with span(result, 'api'):
+                full_entity = await self.client(GetFullChannelRequest(username))
+            self.limiter.success(request)
             if full_entity.full_chat.ttl_period is not None:
                 result['code'] = "FAILURE"
                 result['error_messages'] = "Group has a TTL period"
                 print(f"{datetime.now()} - [WORKER n.{self.pid}] {result['error_messages']}")
                 return None
-            await self.client(JoinChannelRequest(username))
+            request = 'join'
+            await self.acquire(request, result)
+            with span(result, 'api'):
+                await self.client(JoinChannelRequest(username))
+            self.limiter.success(request)
+            self.dialogs.add(full_entity.chats[0])
             print(f"{datetime.now()} - [WORKER n.{self.pid}] Joined '{username}'")
         except telethon.errors.FloodWaitError as e:
             wait = wait_time(e)
-            print(f"{datetime.now()} - [WORKER n.{self.pid}] [!] Flood Error: Waiting for {wait} seconds. ({e})")
-            await asyncio.sleep(wait + 10)
-            await self.join_public_group(username, result)
+            print(f"{datetime.now()} - [WORKER n.{self.pid}] [!] Flood Error on {request} requests: Waiting for {wait} seconds. ({e})")
+            self.flood(request, wait, result)
+            return await self.join_public_group(username, result)
         except telethon.errors.InviteRequestSentError as e:
             result['code'] = "REQUEST_SENT"
             result['id'] = full_entity.full_chat.id
-            result['full_entity'] = full_entity.to_dict()
+            result['full_entity'] = self.serializer.entity(full_entity)
             result['error_messages'] = str(e)
             print(f"{datetime.now()} - [WORKER n.{self.pid}] [!] {e}")
             return None
@@ -94,11 +171,54 @@ class MonitoringWorker:
         return full_entity
     
 
+    async def leave_group(self, entity_id, result):
+        """Leave the group with id ```entity_id```, return False if the account could not leave it."""
+        peer = await self.dialogs.resolve(entity_id)
+        if peer is None:
+            print(f"{datetime.now()} - [WORKER n.{self.pid}] Not in group '{result['username']}', nothing to leave")
+            return True
+        try:
+            await self.acquire('join', result)
+            with span(result, 'api'):
+                await self.client(LeaveChannelRequest(peer))
+            self.limiter.success('join')
+        except telethon.errors.FloodWaitError as e:
+            wait = wait_time(e)
+            print(f"{datetime.now()} - [WORKER n.{self.pid}] [!] Flood Error on join requests: Waiting for {wait} seconds. ({e})")
+            self.flood('join', wait, result)
+            return await self.leave_group(entity_id, result)
+        except Exception as e:
+            result['error_messages'] = str(e)
+            print(f"{datetime.now()} - [WORKER n.{self.pid}] [!] {e}")
+            return False
+        self.dialogs.remove(entity_id)
+        if self.live is not None:
+            self.live.forget(entity_id)
+        print(f"{datetime.now()} - [WORKER n.{self.pid}] Left '{result['username']}'")
+        return True
+
+
     async def check_dialog(self, entity_id, result):
-        async for dialog in self.client.iter_dialogs():
-            if dialog.entity.id == entity_id:
+        if await self.dialogs.resolve(entity_id) is not None:
+            result['code'] = "JOIN_SUCCESS"
+            return entity_id
+        # the group may have no recent activity, ask for the channel itself
+        try:
+            await self.acquire('full_channel', result)
+            with span(result, 'api'):
+                entity = await self.client.get_entity(PeerChannel(entity_id))
+            self.limiter.success('full_channel')
+            if not entity.left:
+                self.dialogs.add(entity)
                 result['code'] = "JOIN_SUCCESS"
                 return entity_id
+        except telethon.errors.FloodWaitError as e:
+            wait = wait_time(e)
+            print(f"{datetime.now()} - [WORKER n.{self.pid}] [!] Flood Error: Waiting for {wait} seconds. ({e})")
+            self.flood('full_channel', wait, result)
+            return await self.check_dialog(entity_id, result)
+        except Exception as e:
+            print(f"{datetime.now()} - [WORKER n.{self.pid}] [!] {e}")
         # No entity with matching id has been found, you are still waiting
         result['code'] = "REQUEST_SENT"
         result['error_messages'] = "Your request has not been approved yet"
@@ -109,142 +229,360 @@ class MonitoringWorker:
     async def check_username(self, entity_id, result):
         try:
             # entity = await self.client.get_entity(entity_id)
-            entity = await self.client(GetFullChannelRequest(entity_id))
-            new_username = entity.chats[0].username
+            await self.acquire('full_channel', result)
+            with span(result, 'api'):
+                entity = await self.client(GetFullChannelRequest(entity_id))
+            self.limiter.success('full_channel')
+        except telethon.errors.FloodWaitError as e:
+            wait = wait_time(e)
+            print(f"{datetime.now()} - [WORKER n.{self.pid}] [!] Flood Error: Waiting for {wait} seconds. ({e})")
+            self.flood('full_channel', wait, result)
+            return await self.check_username(entity_id, result)
         except Exception as e:
             result['code'] = "FAILURE"
             result['error_messages'] = str(e)
             print(f"{datetime.now()} - [WORKER n.{self.pid}] [!] {e}")
             return None
-        return entity.to_dict()
+        return self.serializer.entity(entity)
 
 
-    async def collect_messages(self, entity_id, result, offset_date):
-        """Collect at most ```self.limit``` messages starting from ```offset_date``` from entity with id ```entity_id```."""
-        first = True
-        found = False
-        # store offset_date to start once again from offset_date in case of FloodWaitError
-        last_date = offset_date
-        print(f"{datetime.now()} - [WORKER n.{self.pid}] Collecting messages from '{result['username']}' from date {offset_date}")
+    async def get_channels(self, channels, result):
+        """Look up several channels (```InputChannel```) with a single request."""
         try:
-            async for dialog in self.client.iter_dialogs():
-                if dialog.entity.id == entity_id:
-                    found = True
-                    async for m in self.client.iter_messages(dialog.id, limit=self.messages_limit, reverse=True, offset_date=offset_date, wait_time=60):
-                        if first:
-                            # store date of the first message
-                            first = False
-                            result['first_message'] = m.date
-                        # update db and result dictionary
-                        self.db[f'messages_{entity_id}'].insert_one(m.to_dict())
-                        result['messages'] += 1
-                        # update last_date to restart in case of FloodWaitError
-                        last_date = m.date
+            await self.acquire('full_channel', result)
+            with span(result, 'api'):
+                response = await self.client(GetChannelsRequest(channels))
+            self.limiter.success('full_channel')
         except telethon.errors.FloodWaitError as e:
             wait = wait_time(e)
             print(f"{datetime.now()} - [WORKER n.{self.pid}] [!] Flood Error: Waiting for {wait} seconds. ({e})")
-            await asyncio.sleep(wait + 10)
-            result['messages'] = []
-            await self.collect_messages(entity_id, result, last_date)
-        except Exception as e:
-            result['code'] = "FAILURE"
-            result['error_messages'] = str(e)
-            print(f"{datetime.now()} - [WORKER n.{self.pid}] [!] {e}")
+            self.flood('full_channel', wait, result)
+            return await self.get_channels(channels, result)
+        return response.chats
+
+
+    async def check_usernames(self, groups, result):
+        """Check the usernames of ```groups``` (dictionaries with ```id```, ```username``` and ```full```) with one request.
+        The full channel, with its bots, is only fetched for groups whose username changed or flagged as ```full```."""
+        channels = []
+        checked = []
+        # the groups missing from the dialog index share a single refresh
+        peers = await self.dialogs.resolve_many([group['id'] for group in groups])
+        for group, peer in zip(groups, peers):
+            if isinstance(peer, InputPeerChannel):
+                channels.append(InputChannel(peer.channel_id, peer.access_hash))
+                checked.append((group, True))
+            elif peer is None:
+                result['missing'].append(group['id'])
+            else:
+                # basic groups cannot be looked up with GetChannelsRequest
+                checked.append((dict(group, full=True), False))
+        found = {}
+        if len(channels) > 0:
+            for channel in await self.get_channels(channels, result):
+                found[channel.id] = channel
+        for group, looked_up in checked:
+            channel = found.get(group['id'])
+            if looked_up and not isinstance(channel, Channel):
+                # not returned or forbidden: the account lost access to the group
+                result['missing'].append(group['id'])
+                continue
+            new_username = channel.username if looked_up else group['username']
+            entry = {'id': group['id'], 'username': group['username'], 'new_username': new_username}
+            if group['full'] or new_username != group['username']:
+                new_entity = await self.check_username(group['id'], result)
+                if new_entity is not None:
+                    entry['new_entity'] = new_entity
+                    entry['new_username'] = new_entity['chats'][0].get('username')
+                elif result['code'] == "FAILURE":
+                    # the other groups of the batch are still reported
+                    entry['error'] = result['error_messages']
+                    result['code'] = "ENTITIES_FOUND"
+            result['entities'].append(entry)
+        print(f"{datetime.now()} - [WORKER n.{self.pid}] Checked {len(result['entities'])} usernames, " +
+              f"{sum('new_entity' in entry for entry in result['entities'])} full channels fetched, {len(result['missing'])} groups missing")
+
+
+    async def collect_messages(self, entity_id, result, offset_date, min_id=None):
+        """Collect at most ```self.messages_limit``` messages from entity with id ```entity_id```, starting after the message
+        with id ```min_id``` if given, from ```offset_date``` otherwise. Progress is saved in the ```last_message_id``` field
+        of the group as messages are written, so that a later fetch continues where this one stopped."""
+        found = False
+        remaining = self.messages_limit
+        checkpoint = {'$or': [{'id': entity_id}, {'username': result['username']}]}
+        writer = MessageWriter(self.store.collection(entity_id), self.write_batch_size, self.write_flush_interval,
+                               on_flush=lambda last_id: self.db['groups'].update_one(checkpoint, {'$max': {'last_message_id': last_id}, '$currentDate': {'updated_at': True}}))
+        result['collection_name'] = writer.collection.name
+        # unique message id, the first time the collection is used by this worker
+        await self.pipeline.run(self.indexes.ensure_messages, writer.collection.name, self.store.indexes())
+        start = f"after message {min_id}" if min_id is not None else f"from date {offset_date}"
+        print(f"{datetime.now()} - [WORKER n.{self.pid}] Collecting messages from '{result['username']}' {start}")
+        while True:
+            try:
+                peer = await self.dialogs.resolve(entity_id)
+                if peer is None:
+                    break
+                found = True
+                position = {'offset_date': offset_date} if min_id is None else {'min_id': min_id}
+                count = 0
+                # history is fetched in pages of 100 messages, each page takes a token
+                await self.acquire('history', result)
+                messages = self.client.iter_messages(peer, limit=remaining, reverse=True, wait_time=0, **position)
+                async for m in timed(messages, result, 'api'):
+                    if result['first_message'] is None:
+                        # store date of the first message
+                        result['first_message'] = m.date
+                    # hand the message to the write pipeline, it is flushed in batches
+                    with span(result, 'write'):
+                        await self.pipeline.put(writer, self.store.document(entity_id, self.serializer.message(m)))
+                    # messages come from the oldest, restart after this one in case of FloodWaitError
+                    min_id = m.id
+                    result['last_message_id'] = m.id
+                    count += 1
+                    if remaining is not None:
+                        remaining -= 1
+                    if count % 100 == 0:
+                        self.limiter.success('history')
+                        await self.acquire('history', result)
+                break
+            except telethon.errors.FloodWaitError as e:
+                wait = wait_time(e)
+                # do not keep buffered messages in memory while waiting
+                await self.flush_messages(writer, result)
+                print(f"{datetime.now()} - [WORKER n.{self.pid}] [!] Flood Error: Waiting for {wait} seconds. ({e})")
+                self.flood('history', wait, result)
+            except (telethon.errors.ChannelPrivateError, telethon.errors.ChannelInvalidError) as e:
+                # the account is not in the group anymore
+                self.dialogs.remove(entity_id)
+                result['code'] = "FAILURE"
+                result['error_messages'] = str(e)
+                print(f"{datetime.now()} - [WORKER n.{self.pid}] [!] {e}")
+                break
+            except Exception as e:
+                result['code'] = "FAILURE"
+                result['error_messages'] = str(e)
+                print(f"{datetime.now()} - [WORKER n.{self.pid}] [!] {e}")
+                break
+        await self.flush_messages(writer, result)
+        if writer.broken:
+            # some messages were not stored, the next fetch has to start again from the last checkpoint
+            result['last_message_id'] = None
         if not found:
             result['code'] = "FAILURE"
             result['error_messages'] = "Group not found"
 
 
+    async def fetch_history(self, entity_id, result, offset_date, min_id=None):
+        """Collect the messages of ```entity_id``` with ```collect_messages()```; in live mode the group is streamed from
+        before the fetch starts, and only the gap since the last message received in sync is fetched."""
+        if self.live is None:
+            return await self.collect_messages(entity_id, result, offset_date, min_id)
+        epoch = self.live.watch(entity_id, result['username'])
+        min_id = self.live.resume_from(entity_id, min_id)
+        await self.collect_messages(entity_id, result, offset_date, min_id)
+        # a fetch that could not store every message leaves the group out of sync
+        if result['code'] in ("JOIN_SUCCESS", "UPDATE_SUCCESS") and result['failed_messages'] == 0:
+            self.live.synced(entity_id, epoch, result['last_message_id'] if result['last_message_id'] is not None else min_id)
+
+
+    async def flush_messages(self, writer, result):
+        """Wait for ```writer``` to be flushed and add the number of messages written and failed to ```result```."""
+        with span(result, 'write'):
+            await self.pipeline.flush(writer)
+        flushed, failed = writer.take_counts()
+        result['messages'] += flushed
+        result['failed_messages'] += failed
+        if failed > 0:
+            print(f"{datetime.now()} - [WORKER n.{self.pid}] [!] {failed} messages could not be written to {writer.collection.name}: {writer.errors[-1]}")
+
+
     async def __crawl_worker(self):
         print(f"{datetime.now()} - [WORKER n.{self.pid}] Crawling...")
+        loop = asyncio.get_running_loop()
+        running = set()
+        # the count of free slots kept by the master can drift (restarts, tasks claimed again from the broker),
+        # so the queue is not read while every slot is busy
+        slots = asyncio.Semaphore(self.concurrent_tasks)
+        if hasattr(self.task_queue, 'register'):
+            # a master started later learns from the broker how many slots are free
+            self.task_queue.register(self.concurrent_tasks)
+        # the master holds one slot for each worker, announce the other ones
+        for _ in range(self.concurrent_tasks - 1):
+            self.events.put(('FREE', self.pid))
         while True:
-            # wait for a task to be dispatched to the worker
-            task = self.task_queue.get()
-            lb = self.join_wait_lb
-            ub = self.join_wait_ub
-
-            # TRY_JOIN: join the group and collect messages since:
-            # - starting_date, if starting date is specified
-            # - datetime.now() - timedelta(limit_days) otherwise
-            if task['name'] == "TRY_JOIN":
-                username = task['data']['username']
-                result = {
-                    'code': "JOIN_SUCCESS",
-                    'username': username,
-                    'id': "",
-                    'messages': 0,
-                    'timestamp': None,
-                    'error_messages': "",
-                    'first_message': None,
-                    'worker_id': self.pid
-                }
-                full_entity = await self.join_public_group(username, result)
-                if full_entity is not None:
-                    result['id'] = full_entity.full_chat.id
-                    result['full_entity'] = full_entity.to_dict()
-                    # set offset_date according to the given parametres
-                    offset_date = self.get_offset_date()
-                    await self.collect_messages(result['id'], result, offset_date)
-
-            # CHECK_UPDATES: collect messages since the given offset_date
-            elif task['name'] == "CHECK_UPDATES":
-                data = task['data']
-                result = {
-                    'code': "UPDATE_SUCCESS",
-                    'username': data['username'],
-                    'id': data['id'],
-                    'messages': 0,
-                    'timestamp': None,
-                    'error_messages': "",
-                    'first_message': None,
-                    'worker_id': self.pid
-                }
-                await self.collect_messages(data['id'], result, data['offset_date'])
-            
-            # CHECK_WAIT: check a group you are waiting to be accepted in
-            elif task['name'] == "CHECK_WAIT":
-                data = task['data']
-                result = {
-                    'code': "JOIN_SUCCESS",
-                    'username': data['username'],
-                    'id': data['id'],
-                    'messages': 0,
-                    'timestamp': None,
-                    'error_messages': "",
-                    'first_message': None,
-                    'worker_id': self.pid
-                }
-                entity_id = await self.check_dialog(data['id'], result)
-                if entity_id is not None:
-                    offset_date = self.get_offset_date()
-                    await self.collect_messages(entity_id, result, offset_date)
+            await slots.acquire()
+            # wait for a task to be dispatched to the worker without blocking the event loop
+            task = await loop.run_in_executor(None, self.task_queue.get)
+            job = asyncio.ensure_future(self.__run_task(task))
+            running.add(job)
+            job.add_done_callback(running.discard)
+            job.add_done_callback(lambda job: slots.release())
+
+
+    async def __run_task(self, task):
+        try:
+            await self.__execute_task(task)
+        except Exception as e:
+            # report the failure instead of losing the task and the slot
+            print(f"{datetime.now()} - [WORKER n.{self.pid}] [!] Task {task['name']} failed: {e}")
+            self.events.put(('RESULT', {
+                # a failed move leaves the group where it is
+                'code': FAILURE_CODES.get(task['name'], "FAILURE"),
+                'username': task['data'].get('username', ""),
+                'id': task['data'].get('id', ""),
+                'messages': 0,
+                'failed_messages': 0,
+                'timestamp': datetime.now(tz=timezone.utc),
+                'error_messages': str(e),
+                'first_message': None,
+                'last_message_id': None,
+                'worker_id': self.pid,
+                'task': task['name']
+            }))
+            self.ack(task)
+            self.events.put(('FREE', self.pid))
+
+
+    def ack(self, task):
+        # tasks claimed from a broker are deleted once their result has been sent
+        if 'lease' in task:
+            self.task_queue.ack(task)
+
+
+    async def __execute_task(self, task):
+        started = time.time()
+        # TRY_JOIN: join the group and collect messages since:
+        # - starting_date, if starting date is specified
+        # - datetime.now() - timedelta(limit_days) otherwise
+        if task['name'] == "TRY_JOIN":
+            username = task['data']['username']
+            result = {
+                'code': "JOIN_SUCCESS",
+                'username': username,
+                'id': "",
+                'messages': 0,
+                'failed_messages': 0,
+                'timestamp': None,
+                'error_messages': "",
+                'first_message': None,
+                'last_message_id': None,
+                'worker_id': self.pid
+            }
+            full_entity = await self.join_public_group(username, result)
+            if full_entity is not None:
+                result['id'] = full_entity.full_chat.id
+                result['full_entity'] = self.serializer.entity(full_entity)
+                # set offset_date according to the given parametres
+                offset_date = self.get_offset_date()
+                # min_id is set when a previous attempt stored some messages before its task was lost
+                await self.fetch_history(result['id'], result, offset_date, task['data'].get('min_id'))
+
+        # CHECK_UPDATES: collect messages since the given offset_date
+        elif task['name'] == "CHECK_UPDATES":
+            data = task['data']
+            result = {
+                'code': "UPDATE_SUCCESS",
+                'username': data['username'],
+                'id': data['id'],
+                'messages': 0,
+                'failed_messages': 0,
+                'timestamp': None,
+                'error_messages': "",
+                'first_message': None,
+                'last_message_id': None,
+                'worker_id': self.pid
+            }
+            if self.live is not None and self.live.in_sync(data['id']):
+                # nothing was missed: the messages received since the last check are reported
+                await self.live.report(data['id'], result)
+            else:
+                await self.fetch_history(data['id'], result, data['offset_date'], data.get('min_id'))
+        
+        # CHECK_WAIT: check a group you are waiting to be accepted in
+        elif task['name'] == "CHECK_WAIT":
+            data = task['data']
+            result = {
+                'code': "JOIN_SUCCESS",
+                'username': data['username'],
+                'id': data['id'],
+                'messages': 0,
+                'failed_messages': 0,
+                'timestamp': None,
+                'error_messages': "",
+                'first_message': None,
+                'last_message_id': None,
+                'worker_id': self.pid
+            }
+            entity_id = await self.check_dialog(data['id'], result)
+            if entity_id is not None:
+                offset_date = self.get_offset_date()
+                await self.fetch_history(entity_id, result, offset_date, data.get('min_id'))
+        
+        # MOVE_JOIN: join a group another worker is in, the other worker then leaves it
+        elif task['name'] == "MOVE_JOIN":
+            data = task['data']
+            result = {
+                'code': "MOVE_SUCCESS",
+                'username': data['username'],
+                'id': data['id'],
+                'from_worker': data['from_worker'],
+                'messages': 0,
+                'failed_messages': 0,
+                'timestamp': None,
+                'error_messages': "",
+                'first_message': None,
+                'last_message_id': None,
+                'worker_id': self.pid
+            }
+            # messages are still collected by the other worker until the master moves the group
+            if await self.join_public_group(data['username'], result) is None:
+                result['code'] = "MOVE_FAILED"
+
+        # LEAVE: leave a group that has been moved to another worker
+        elif task['name'] == "LEAVE":
+            data = task['data']
+            result = {
+                'code': "LEFT",
+                'username': data['username'],
+                'id': data['id'],
+                'messages': 0,
+                'failed_messages': 0,
+                'timestamp': None,
+                'error_messages': "",
+                'first_message': None,
+                'last_message_id': None,
+                'worker_id': self.pid
+            }
+            if not await self.leave_group(data['id'], result):
+                result['code'] = "LEAVE_FAILED"
+
+        # CHECK_USERNAMES: check the usernames of a batch of groups
+        elif task['name'] == "CHECK_USERNAMES":
+            result = {
+                'code': "ENTITIES_FOUND",
+                'username': "",
+                'id': "",
+                'messages': 0,
+                'failed_messages': 0,
+                'timestamp': None,
+                'error_messages': "",
+                'first_message': None,
+                'last_message_id': None,
+                'entities': [],
+                'missing': [],
+                'worker_id': self.pid
+            }
+            await self.check_usernames(task['data']['groups'], result)
             
-            elif task['name'] == "CHECK_USERNAME":
-                lb = self.leave_wait_lb
-                ub = self.leave_wait_ub
-                data = task['data']
-                result = {
-                    'code': "ENTITY_FOUND",
-                    'username': data['username'],
-                    'id': data['id'],
-                    'messages': 0,
-                    'timestamp': None,
-                    'error_messages': "",
-                    'first_message': None,
-                    'new_username': '',
-                    'worker_id': self.pid
-                }
-                new_entity = await self.check_username(data['id'], result)
-                if new_entity is not None:
-                    result['new_entity'] = new_entity
-                
-            # put result in result_queue
-            result['timestamp'] = datetime.now(tz=timezone.utc)
-            self.result_queue.put(result)
-            # wait for join_wait_lb < n < join_wait_ub sec before joining a group
-            wait_time = random.randint(lb, ub)
-            print(f"{datetime.now()} - [WORKER n.{self.pid}] waiting {wait_time} seconds...")
-            await asyncio.sleep(wait_time)
-            # put pid back in process_queue
-            print(f"{datetime.now()} - [WORKER n.{self.pid}]: Finished waiting")
-            self.process_queue.put(self.pid)
\ No newline at end of file
+        # time breakdown of the task, the master aggregates it
+        result['task'] = task['name']
+        spans = result.setdefault('spans', {})
+        spans['total'] = time.time() - started
+        if 'dispatched' in task:
+            spans['queue'] = started - task['dispatched']
+        # send the result, then give the slot back (pacing is left to the rate limiter)
+        result['timestamp'] = datetime.now(tz=timezone.utc)
+        self.events.put(('RESULT', result))
+        # the task is deleted before its slot is announced, so that a slot is never counted twice by free_slots()
+        self.ack(task)
+        self.events.put(('FREE', self.pid))
\ No newline at end of file
@@ -0,0 +1,175 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import asyncio
+import time
+import pymongo
+
+
+class MessageWriter:
+    def __init__(self, collection, batch_size=500, flush_interval=5, key='id', on_flush=None):
+        """Buffer documents for ```collection``` and write them with ```insert_many(ordered=False)```.
+        The buffer is flushed when ```batch_size``` documents are pending or when ```flush_interval```
+        seconds have passed since the last flush. After each flush in which every document has been stored,
+        ```on_flush``` is called with the highest ```key``` written so far."""
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.key = key
+        self.on_flush = on_flush
+        # set when a document could not be stored: the high-water mark cannot move past it
+        self.broken = False
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        # number of documents written, already stored and rejected by the database
+        self.flushed = 0
+        self.duplicates = 0
+        self.failed = 0
+        self.errors = []
+        # counters already reported by take_counts()
+        self.reported_flushed = 0
+        self.reported_failed = 0
+
+
+    def append(self, doc):
+        self.buffer.append(doc)
+
+
+    def due(self):
+        if len(self.buffer) == 0:
+            return False
+        return len(self.buffer) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval
+
+
+    def add(self, doc):
+        """Add ```doc``` to the buffer, flushing it if the size or the time limit has been reached."""
+        self.append(doc)
+        if self.due():
+            self.flush()
+
+
+    def flush(self):
+        """Write all pending documents, return the number of documents actually inserted."""
+        self.last_flush = time.monotonic()
+        if len(self.buffer) == 0:
+            return 0
+        batch = self.buffer
+        self.buffer = []
+        duplicates = 0
+        try:
+            inserted = len(self.collection.insert_many(batch, ordered=False).inserted_ids)
+        except pymongo.errors.BulkWriteError as e:
+            # with ordered=False every document without errors has been inserted anyway
+            inserted = e.details['nInserted']
+            errors = [error for error in e.details['writeErrors'] if error['code'] != 11000]
+            duplicates = len(e.details['writeErrors']) - len(errors)
+            if len(errors) > 0:
+                self.errors.append(str(errors[0]['errmsg']))
+        except Exception as e:
+            inserted = 0
+            self.errors.append(str(e))
+            print(f"{datetime.now()} - [WRITER] [!] Error while writing to {self.collection.name}: {e}")
+        failed = len(batch) - inserted - duplicates
+        self.flushed += inserted
+        self.duplicates += duplicates
+        self.failed += failed
+        if failed > 0:
+            self.broken = True
+        if not self.broken and self.on_flush is not None:
+            try:
+                self.on_flush(max(doc[self.key] for doc in batch))
+            except Exception as e:
+                print(f"{datetime.now()} - [WRITER] [!] Could not save the progress of {self.collection.name}: {e}")
+        return inserted
+
+
+    def take_counts(self):
+        """Return the number of documents written and failed since the last call."""
+        flushed = self.flushed - self.reported_flushed
+        failed = self.failed - self.reported_failed
+        self.reported_flushed += flushed
+        self.reported_failed += failed
+        return flushed, failed
+
+
+class WritePipeline:
+    def __init__(self, maxsize=10000, flush_interval=5, metrics=None):
+        """Move database writes out of the event loop: producers put documents in a bounded queue,
+        a consumer coroutine batches them and flushes through a dedicated writer thread.
+        When the queue is full ```put()``` blocks, slowing down the producer.
+        The duration of each flush is observed in ```metrics``` if given."""
+        self.maxsize = maxsize
+        self.flush_interval = flush_interval
+        self.metrics = metrics
+        self.queue = None
+        self.consumer = None
+        self.executor = None
+        # writers with documents that have not been flushed yet
+        self.pending = set()
+
+
+    def start(self):
+        # the queue and the consumer must be created inside the running event loop
+        self.queue = asyncio.Queue(self.maxsize)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.consumer = asyncio.ensure_future(self.__consume())
+
+
+    async def stop(self):
+        await self.queue.put((None, None))
+        await self.consumer
+        self.executor.shutdown()
+
+
+    async def run(self, function, *args):
+        """Run a blocking database operation in the writer thread."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+
+    async def put(self, writer, doc):
+        """Enqueue ```doc``` to be written through ```writer```."""
+        await self.queue.put((writer, doc))
+
+
+    async def flush(self, writer):
+        """Wait until every document enqueued for ```writer``` has been written."""
+        done = asyncio.get_running_loop().create_future()
+        await self.queue.put((writer, done))
+        await done
+
+
+    def __timed_flush(self, writer):
+        if self.metrics is None:
+            return writer.flush()
+        with self.metrics.time('db_seconds', "Duration of database operations", operation='insert_messages'):
+            inserted = writer.flush()
+        self.metrics.inc('messages_written_total', inserted, "Messages inserted in the database")
+        return inserted
+
+
+    async def __flush(self, writer):
+        self.pending.discard(writer)
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.__timed_flush, writer)
+
+
+    async def __consume(self):
+        while True:
+            try:
+                writer, item = await asyncio.wait_for(self.queue.get(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                # queue is idle: flush the writers that reached the time limit
+                for writer in [writer for writer in self.pending if writer.due()]:
+                    await self.__flush(writer)
+                continue
+            if writer is None:
+                # stop: flush everything left
+                for writer in list(self.pending):
+                    await self.__flush(writer)
+                break
+            if isinstance(item, asyncio.Future):
+                await self.__flush(writer)
+                item.set_result(None)
+            else:
+                writer.append(item)
+                self.pending.add(writer)
+                if writer.due():
+                    await self.__flush(writer)